@@ -6,9 +6,123 @@
 
 import pandas as pd
 import numpy as np
-from collections import defaultdict
+from pathlib import Path
 
-def analyze_one_to_many(df, key_field, value_field, description):
+CSV_FILE = 'Karg_food_flows_locations.csv'
+PARQUET_CACHE = 'Karg_food_flows_locations.parquet'  # 列式缓存，避免每次重新解析CSV
+
+# 需要做分组统计的字符串列
+CATEGORY_COLUMNS = [
+    'source_nam', 'destination_name', 'city', 'commodit_1', 'means_of_t',
+    'Source_country_name', 'Dest_country_name'
+]
+
+def load_df(csv_path=CSV_FILE, cache_path=PARQUET_CACHE):
+    """
+    加载数据: 优先读取Parquet缓存，CSV比缓存新或缓存不存在时重新解析CSV
+    """
+    csv_file = Path(csv_path)
+    cache_file = Path(cache_path)
+    if cache_file.exists() and cache_file.stat().st_mtime >= csv_file.stat().st_mtime:
+        print(f"  (使用缓存 {cache_file})")
+        return pd.read_parquet(cache_file)
+    
+    try:
+        # PyArrow引擎多线程解析CSV，结果与默认C引擎一致
+        df = pd.read_csv(csv_file, encoding='utf-8-sig', engine='pyarrow')
+    except (ImportError, ValueError):
+        # 未安装pyarrow或解析失败时退回默认引擎
+        df = pd.read_csv(csv_file, encoding='utf-8-sig', low_memory=False)
+    df['year_clean'] = pd.to_numeric(df['year'], errors='coerce')
+    
+    try:
+        df.to_parquet(cache_file, compression='zstd')
+    except Exception as e:
+        # 缺少pyarrow或列类型混杂时不缓存，不影响分析
+        print(f"  (未写入缓存: {e})")
+    return df
+
+def compute_all_stats(df, fields):
+    """
+    预先把各字段编码为整数(缺失值为-1)，供所有关系分析共用
+    
+    各种字段组合的唯一值统计在首次使用时计算并缓存，
+    重复出现的组合(如 source_nam + destination_name)只计算一次
+    """
+    all_stats = {'codes': {}, 'uniques': {}, 'combos': {}}
+    for field in fields:
+        add_field_codes(all_stats, field, df[field])
+    return all_stats
+
+def add_field_codes(all_stats, field, values):
+    """
+    把一列(Series或数组)编码为整数加入all_stats，可用于不在df中的派生列
+    """
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        all_stats['codes'][field] = values.cat.codes.to_numpy(np.int64)
+        all_stats['uniques'][field] = values.cat.categories
+    else:
+        field_codes, field_uniques = pd.factorize(values, sort=True)
+        all_stats['codes'][field] = field_codes.astype(np.int64)
+        all_stats['uniques'][field] = field_uniques
+
+def urban_mask(series):
+    """
+    城乡标记列 → 布尔数组：'yes'(不区分大小写)为True，缺失值视为非城市
+    只对不重复的取值做字符串转换和比较，再按编码展开到每一行
+    """
+    codes, uniques = pd.factorize(series)
+    is_yes = np.asarray(pd.Index(uniques).astype(str).str.lower() == 'yes', dtype=bool)
+    return is_yes[codes] & (codes >= 0)
+
+def unique_combos(all_stats, *fields):
+    """
+    返回字段组合的唯一打包键(已排序)及每个组合的记录数，忽略含缺失值的记录
+    """
+    if fields in all_stats['combos']:
+        return all_stats['combos'][fields]
+    
+    codes = [all_stats['codes'][f] for f in fields]
+    sizes = [len(all_stats['uniques'][f]) for f in fields]
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    
+    # 多列编码打包为单个int64键 (混合进制)
+    key = np.zeros(int(valid.sum()), dtype=np.int64)
+    key_size = 1
+    for c, size in zip(codes, sizes):
+        if key_size * size >= 2**63:
+            # 取值空间超出int64时，先把已打包部分压缩为连续编号(保持排序)再继续
+            key_uniques, key = np.unique(key, return_inverse=True)
+            key_size = len(key_uniques)
+        key = key * size + c[valid]
+        key_size *= size
+    result = np.unique(key, return_counts=True)
+    all_stats['combos'][fields] = result
+    return result
+
+def count_unique_values(all_stats, field):
+    """字段的唯一值数量 (等价于 nunique)"""
+    return len(unique_combos(all_stats, field)[0])
+
+def one_to_many_counts(all_stats, key_field, value_field):
+    """
+    每个key对应多少个不同的value (等价于 groupby(key)[value].nunique())
+    """
+    pair_keys, _ = unique_combos(all_stats, key_field, value_field)
+    n_keys = len(all_stats['uniques'][key_field])
+    n_values = len(all_stats['uniques'][value_field])
+    counts = np.bincount(pair_keys // n_values, minlength=n_keys)
+    
+    # value全部缺失的key也要保留(计数为0)，与nunique一致
+    key_codes = all_stats['codes'][key_field]
+    present = np.bincount(key_codes[key_codes >= 0], minlength=n_keys) > 0
+    return pd.Series(
+        counts[present],
+        index=pd.Index(all_stats['uniques'][key_field][present], name=key_field),
+        name=value_field
+    )
+
+def analyze_one_to_many(df, key_field, value_field, description, all_stats=None):
     """
     分析一对多关系: 一个key对应多少个不同的values
     """
@@ -18,15 +132,24 @@ def analyze_one_to_many(df, key_field, value_field, description):
     print(f"{'='*90}")
     
     # 对于每个key，统计有多少个不同的values
-    relationship = df.groupby(key_field)[value_field].nunique()
-    
+    if all_stats is not None:
+        relationship = one_to_many_counts(all_stats, key_field, value_field)
+    else:
+        # 先按(key, value)分组得到唯一组合，再按key计数，比逐组nunique快得多
+        relationship = (
+            df.groupby([key_field, value_field], observed=True).size()
+            .groupby(level=0, observed=True).size()
+        )
+    
+    # describe() 一次算出 count/mean/std/min/max
+    summary = relationship.describe()
     stats = {
-        'total_keys': len(relationship),
-        'mean': relationship.mean(),
+        'total_keys': int(summary['count']),
+        'mean': summary['mean'],
         'median': relationship.median(),
-        'min': relationship.min(),
-        'max': relationship.max(),
-        'std': relationship.std()
+        'min': int(summary['min']),
+        'max': int(summary['max']),
+        'std': summary['std']
     }
     
     print(f"\n统计信息:")
@@ -40,8 +163,11 @@ def analyze_one_to_many(df, key_field, value_field, description):
     # 分布分析
     print(f"\n分布:")
     distribution = relationship.value_counts().sort_index()
-    for count, freq in distribution.head(10).items():
-        percentage = freq / len(relationship) * 100
+    # 转为numpy数组再迭代，避免逐个装箱Series标量
+    top_distribution = distribution.head(10)
+    total = len(relationship)
+    for count, freq in zip(top_distribution.index.to_numpy(), top_distribution.to_numpy()):
+        percentage = freq / total * 100
         print(f"  {count:3d} 个 {value_field}: {freq:5,} 个 {key_field} ({percentage:5.1f}%)")
     
     if len(distribution) > 10:
@@ -52,12 +178,12 @@ def analyze_one_to_many(df, key_field, value_field, description):
     top_5 = relationship.nlargest(5)
     if len(top_5) > 0:
         print(f"\n最多样化的5个 {key_field}:")
-        for key, count in top_5.items():
+        for key, count in zip(top_5.index.to_numpy(), top_5.to_numpy()):
             print(f"  {key}: {count} 个不同的 {value_field}")
     
     return stats, relationship
 
-def analyze_many_to_many(df, field_a, field_b, description):
+def analyze_many_to_many(df, field_a, field_b, description, all_stats=None):
     """
     分析多对多关系: A和B之间的复杂关系
     """
@@ -66,13 +192,18 @@ def analyze_many_to_many(df, field_a, field_b, description):
     print(f"多对多分析: {field_a} ↔ {field_b}")
     print(f"{'='*90}")
     
-    # A → B: 每个A对应多少个B
-    a_to_b = df.groupby(field_a)[field_b].nunique()
-    # B → A: 每个B对应多少个A
-    b_to_a = df.groupby(field_b)[field_a].nunique()
-    
-    # A-B组合的唯一数量
-    unique_pairs = df.groupby([field_a, field_b]).size()
+    if all_stats is not None:
+        a_to_b = one_to_many_counts(all_stats, field_a, field_b)
+        b_to_a = one_to_many_counts(all_stats, field_b, field_a)
+        unique_pairs = pd.Series(unique_combos(all_stats, field_a, field_b)[1])
+    else:
+        # A → B: 每个A对应多少个B
+        a_to_b = df.groupby(field_a, observed=True)[field_b].nunique()
+        # B → A: 每个B对应多少个A
+        b_to_a = df.groupby(field_b, observed=True)[field_a].nunique()
+        
+        # A-B组合的唯一数量
+        unique_pairs = df.groupby([field_a, field_b], observed=True).size()
     
     print(f"\n方向1: {field_a} → {field_b}")
     print(f"  {len(a_to_b):,} 个不同的 {field_a}")
@@ -107,7 +238,7 @@ def analyze_many_to_many(df, field_a, field_b, description):
         'unique_pairs': len(unique_pairs)
     }
 
-def analyze_triple_relationship(df, field1, field2, field3, description):
+def analyze_triple_relationship(df, field1, field2, field3, description, all_stats=None):
     """
     分析三字段关系: field1-field2-field3的组合情况
     """
@@ -117,13 +248,22 @@ def analyze_triple_relationship(df, field1, field2, field3, description):
     print(f"{'='*90}")
     
     # 统计各种组合
-    unique_1 = df[field1].nunique()
-    unique_2 = df[field2].nunique()
-    unique_3 = df[field3].nunique()
-    unique_12 = df.groupby([field1, field2]).ngroups
-    unique_13 = df.groupby([field1, field3]).ngroups
-    unique_23 = df.groupby([field2, field3]).ngroups
-    unique_123 = df.groupby([field1, field2, field3]).ngroups
+    if all_stats is not None:
+        unique_1 = count_unique_values(all_stats, field1)
+        unique_2 = count_unique_values(all_stats, field2)
+        unique_3 = count_unique_values(all_stats, field3)
+        unique_12 = len(unique_combos(all_stats, field1, field2)[0])
+        unique_13 = len(unique_combos(all_stats, field1, field3)[0])
+        unique_23 = len(unique_combos(all_stats, field2, field3)[0])
+        unique_123 = len(unique_combos(all_stats, field1, field2, field3)[0])
+    else:
+        unique_1 = df[field1].nunique()
+        unique_2 = df[field2].nunique()
+        unique_3 = df[field3].nunique()
+        unique_12 = df.groupby([field1, field2], observed=True).ngroups
+        unique_13 = df.groupby([field1, field3], observed=True).ngroups
+        unique_23 = df.groupby([field2, field3], observed=True).ngroups
+        unique_123 = df.groupby([field1, field2, field3], observed=True).ngroups
     
     print(f"\n单字段唯一值:")
     print(f"  {field1}: {unique_1:,}")
@@ -168,14 +308,17 @@ def main():
     
     # 加载数据
     print("\n加载数据...")
-    df = pd.read_csv('Karg_food_flows_locations.csv', encoding='utf-8-sig', low_memory=False)
+    df = load_df()
     print(f"总记录数: {len(df):,}")
     
     # 清理数据
-    df['year_clean'] = pd.to_numeric(df['year'], errors='coerce')
-    df = df[df['year_clean'].between(2013, 2017)]
+    df = df[df['year_clean'].between(2013, 2017)].copy()
     print(f"清理后记录数: {len(df):,}")
     
+    # 字符串列转为category，后续groupby只需比较整数编码
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    
     # 关键字段列表
     fields = {
         'source_nam': '来源地点',
@@ -188,11 +331,22 @@ def main():
         'Dest_country_name': '目的国家'
     }
     
+    # 路线 = 来源 → 目的地，用两列category编码组合成整数键，避免拼接字符串
+    # (报告中只输出路线数量，不需要还原成 "来源 → 目的地" 文本)
+    src_codes = df['source_nam'].cat.codes.to_numpy(np.int64)
+    dest_codes = df['destination_name'].cat.codes.to_numpy(np.int64)
+    pair_codes = src_codes * len(df['destination_name'].cat.categories) + dest_codes
+    df['route_pair'] = pd.array(pair_codes, dtype='Int64')
+    df.loc[(src_codes < 0) | (dest_codes < 0), 'route_pair'] = pd.NA
+    
+    # 所有字段只编码一次，各项分析共用组合统计结果
+    all_stats = compute_all_stats(df, list(fields) + ['route_pair'])
+    
     print(f"\n关键字段唯一值统计:")
     print(f"{'字段':<25} {'唯一值数量':>15} {'说明'}")
     print("-" * 90)
     for field, desc in fields.items():
-        unique_count = df[field].nunique()
+        unique_count = count_unique_values(all_stats, field)
         print(f"{field:<25} {unique_count:>15,} {desc}")
     
     # ==================== 第一部分: 一对多关系 ====================
@@ -204,32 +358,36 @@ def main():
     # 1. 来源地点 → 目的地点
     analyze_one_to_many(
         df, 'source_nam', 'destination_name',
-        "【来源 → 目的地】一个来源地点可以到达多少个不同的目的地？"
+        "【来源 → 目的地】一个来源地点可以到达多少个不同的目的地？",
+        all_stats=all_stats
     )
     
     # 2. 目的地点 → 来源地点
     analyze_one_to_many(
         df, 'destination_name', 'source_nam',
-        "【目的地 → 来源】一个目的地可以从多少个不同的来源接收？"
+        "【目的地 → 来源】一个目的地可以从多少个不同的来源接收？",
+        all_stats=all_stats
     )
     
     # 3. 来源 → 商品
     analyze_one_to_many(
         df, 'source_nam', 'commodit_1',
-        "【来源 → 商品】一个来源地点出产/运输多少种不同的商品？"
+        "【来源 → 商品】一个来源地点出产/运输多少种不同的商品？",
+        all_stats=all_stats
     )
     
     # 4. 商品 → 来源
     analyze_one_to_many(
         df, 'commodit_1', 'source_nam',
-        "【商品 → 来源】一种商品来自多少个不同的来源？"
+        "【商品 → 来源】一种商品来自多少个不同的来源？",
+        all_stats=all_stats
     )
     
     # 5. 城市 → 路线
-    df['route_pair'] = df['source_nam'] + ' → ' + df['destination_name']
     analyze_one_to_many(
         df, 'city', 'route_pair',
-        "【中转城市 → 路线】一个中转城市服务多少条不同的路线？"
+        "【中转城市 → 路线】一个中转城市服务多少条不同的路线？",
+        all_stats=all_stats
     )
     
     # ==================== 第二部分: 多对多关系 ====================
@@ -241,31 +399,36 @@ def main():
     # 1. 来源 ↔ 商品
     analyze_many_to_many(
         df, 'source_nam', 'commodit_1',
-        "【来源 ↔ 商品】来源地点和商品的关系"
+        "【来源 ↔ 商品】来源地点和商品的关系",
+        all_stats=all_stats
     )
     
     # 2. 来源 ↔ 交通方式
     analyze_many_to_many(
         df, 'source_nam', 'means_of_t',
-        "【来源 ↔ 交通方式】来源地点和交通方式的关系"
+        "【来源 ↔ 交通方式】来源地点和交通方式的关系",
+        all_stats=all_stats
     )
     
     # 3. 商品 ↔ 交通方式
     analyze_many_to_many(
         df, 'commodit_1', 'means_of_t',
-        "【商品 ↔ 交通方式】商品和交通方式的关系"
+        "【商品 ↔ 交通方式】商品和交通方式的关系",
+        all_stats=all_stats
     )
     
     # 4. 路线 ↔ 商品
     analyze_many_to_many(
         df, 'route_pair', 'commodit_1',
-        "【路线 ↔ 商品】路线和商品的关系"
+        "【路线 ↔ 商品】路线和商品的关系",
+        all_stats=all_stats
     )
     
     # 5. 路线 ↔ 年份
     analyze_many_to_many(
         df, 'route_pair', 'year_clean',
-        "【路线 ↔ 年份】路线在不同年份的活跃情况"
+        "【路线 ↔ 年份】路线在不同年份的活跃情况",
+        all_stats=all_stats
     )
     
     # ==================== 第三部分: 三字段关系 ====================
@@ -277,25 +440,29 @@ def main():
     # 1. 来源-城市-目的地
     analyze_triple_relationship(
         df, 'source_nam', 'city', 'destination_name',
-        "【来源-中转城市-目的地】三点路线结构"
+        "【来源-中转城市-目的地】三点路线结构",
+        all_stats=all_stats
     )
     
     # 2. 来源-目的地-商品
     analyze_triple_relationship(
         df, 'source_nam', 'destination_name', 'commodit_1',
-        "【来源-目的地-商品】路线商品组合"
+        "【来源-目的地-商品】路线商品组合",
+        all_stats=all_stats
     )
     
     # 3. 来源-目的地-年份
     analyze_triple_relationship(
         df, 'source_nam', 'destination_name', 'year_clean',
-        "【来源-目的地-年份】路线时间分布"
+        "【来源-目的地-年份】路线时间分布",
+        all_stats=all_stats
     )
     
     # 4. 来源-目的地-交通方式
     analyze_triple_relationship(
         df, 'source_nam', 'destination_name', 'means_of_t',
-        "【来源-目的地-交通方式】路线运输方式"
+        "【来源-目的地-交通方式】路线运输方式",
+        all_stats=all_stats
     )
     
     # ==================== 第四部分: 聚合影响分析 ====================
@@ -307,11 +474,12 @@ def main():
     print(f"\n当前聚合逻辑: source + city + destination + flow_type")
     
     # 计算不同聚合策略的结果
-    df['flow_type'] = df.apply(
-        lambda row: 'rural_to_urban' if str(row['source_wit']).lower() != 'yes' and 
-                    str(row['destination_within_urban_boundary']).lower() == 'yes'
-                    else 'other',
-        axis=1
+    # 向量化判断城乡属性 (缺失值视为非城市)
+    src_urban = urban_mask(df['source_wit'])
+    dest_urban = urban_mask(df['destination_within_urban_boundary'])
+    df['flow_type'] = pd.Categorical(
+        np.where(~src_urban & dest_urban, 'rural_to_urban', 'other'),
+        categories=['rural_to_urban', 'other']
     )
     
     strategies = {
@@ -325,21 +493,19 @@ def main():
     print(f"{'策略':<30} {'聚合后路线数':>15} {'压缩比':>10}")
     print("-" * 90)
     
+    # 各策略共用同一套整数编码，组合数用打包键计数，不再逐个策略groupby
+    add_field_codes(all_stats, 'flow_type', df['flow_type'])
+    # 模拟坐标舍入 (舍入后的数组直接编码，无需复制整个DataFrame)
+    for col in ['Source x', 'Source y', 'Destination x', 'Destination y']:
+        add_field_codes(all_stats, f'{col} (rounded)', np.round(df[col].to_numpy(), 3))
+    strategies['当前策略(+坐标舍入)'] = [
+        'Source x (rounded)', 'Source y (rounded)', 'Destination x (rounded)',
+        'Destination y (rounded)', 'city', 'flow_type'
+    ]
+    
     original_count = len(df)
     for name, fields in strategies.items():
-        if name == '当前策略(+坐标舍入)':
-            # 模拟坐标舍入
-            df_temp = df.copy()
-            df_temp['src_x_rounded'] = df_temp['Source x'].round(3)
-            df_temp['src_y_rounded'] = df_temp['Source y'].round(3)
-            df_temp['dest_x_rounded'] = df_temp['Destination x'].round(3)
-            df_temp['dest_y_rounded'] = df_temp['Destination y'].round(3)
-            grouped_count = df_temp.groupby(
-                ['src_x_rounded', 'src_y_rounded', 'dest_x_rounded', 
-                 'dest_y_rounded', 'city', 'flow_type']
-            ).ngroups
-        else:
-            grouped_count = df.groupby(fields).ngroups
+        grouped_count = len(unique_combos(all_stats, *fields)[0])
         
         compression_ratio = original_count / grouped_count
         print(f"{name:<30} {grouped_count:>15,} {compression_ratio:>9.1f}x")
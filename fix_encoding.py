@@ -7,52 +7,68 @@
 import pandas as pd
 import re
 
-def fix_encoding_errors(text):
-    """修复常见的编码错误 - UTF-8被误解析为Latin-1/Windows-1252"""
-    if pd.isna(text):
+# 修复编码错误映射表（编解码器无法还原时的后备）
+# 原理：UTF-8的多字节序列被错误地按单字节编码解析
+# 例如：UTF-8的 é (C3 A9) 被当作两个Mac Roman字符 √© 
+ENCODING_REPLACEMENTS = {
+    # === 最常见的组合 (√ + 其他字符) ===
+    '√©': 'é',   # e with acute - 30,729次
+    '√¥': 'ô',   # o with circumflex - 832次
+    '√®': 'è',   # e with grave - 194次
+    '√¢': 'â',   # a with circumflex
+    '√Ø': 'ô',   # o with circumflex (另一种编码)
+    '√™': 'ê',   # e with circumflex
+    '√†': 'à',   # a with grave
+    '√Æ': 'î',   # i with circumflex
+    '√π': 'ù',   # u with grave
+    '√ª': 'û',   # u with circumflex
+    '√ß': 'ç',   # c with cedilla
+    '√â': 'É',   # E with acute
+    '√Ä': 'À',   # A with grave
+    '√´': 'ú',   # u with acute
+    '√≥': 'ó',   # o with acute
+    '√≠': 'í',   # i with acute
+    '√±': 'ñ',   # n with tilde
+    
+    # === 单独的特殊符号（可能残留） ===
+    '¢': 'â',    # CENT SIGN - 可能是â的一部分
+    '¥': 'ô',    # YEN SIGN - 可能是ô的一部分
+    '®': 'è',    # REGISTERED SIGN - 可能是è的一部分
+    '©': 'é',    # COPYRIGHT SIGN - 可能是é的一部分
+    '≠': 'é',    # NOT EQUAL TO - 可能是é的一部分
+    
+    # === 其他可能的组合 ===
+    '¬©': 'é',   # 另一种编码错误
+    '¬´': 'ó',
+    '¬≠': 'í',
+}
+
+# 所有错误序列编译为一个正则，长的在前（避免部分替换问题），一次扫描完成全部替换
+ENCODING_PATTERN = re.compile('|'.join(
+    re.escape(wrong) for wrong in sorted(ENCODING_REPLACEMENTS, key=len, reverse=True)
+))
+
+# 编码错误标记字符（检测用，字符类比多选一正则更快）
+ERROR_MARKERS = ['√', '¢', '¥', '©', '®', '≠']
+ERROR_MARKER_PATTERN = re.compile('[' + ''.join(ERROR_MARKERS) + ']')
+
+# 乱码成因：UTF-8字节被按 Mac Roman 单字节解码（√ 即 Mac Roman 的 0xC3）
+# 按 Mac Roman 重新编码再用 UTF-8 解码即可一次还原，映射表只用于处理残留
+MOJIBAKE_CODEC = 'mac_roman'
+
+def _replace_match(match):
+    return ENCODING_REPLACEMENTS[match.group(0)]
+
+def decode_mojibake(text):
+    """用编解码器还原乱码；不是完整的乱码序列（无法编码/解码）时原样返回"""
+    try:
+        return text.encode(MOJIBAKE_CODEC).decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
         return text
-    
-    text = str(text)
-    
-    # 修复编码错误映射表
-    # 原理：UTF-8的多字节序列被错误地按单字节编码解析
-    # 例如：UTF-8的 é (C3 A9) 被当作两个Latin-1字符 √© 
-    replacements = {
-        # === 最常见的组合 (√ + 其他字符) ===
-        '√©': 'é',   # e with acute - 30,729次
-        '√¥': 'ô',   # o with circumflex - 832次
-        '√®': 'è',   # e with grave - 194次
-        '√¢': 'â',   # a with circumflex
-        '√Ø': 'ô',   # o with circumflex (另一种编码)
-        '√™': 'ê',   # e with circumflex
-        '√†': 'à',   # a with grave
-        '√Æ': 'î',   # i with circumflex
-        '√π': 'ù',   # u with grave
-        '√ª': 'û',   # u with circumflex
-        '√ß': 'ç',   # c with cedilla
-        '√â': 'É',   # E with acute
-        '√Ä': 'À',   # A with grave
-        '√´': 'ú',   # u with acute
-        '√≥': 'ó',   # o with acute
-        '√≠': 'í',   # i with acute
-        '√±': 'ñ',   # n with tilde
-        
-        # === 单独的特殊符号（可能残留） ===
-        '¢': 'â',    # CENT SIGN - 可能是â的一部分
-        '¥': 'ô',    # YEN SIGN - 可能是ô的一部分
-        '®': 'è',    # REGISTERED SIGN - 可能是è的一部分
-        '©': 'é',    # COPYRIGHT SIGN - 可能是é的一部分
-        '≠': 'é',    # NOT EQUAL TO - 可能是é的一部分
-        
-        # === 其他可能的组合 ===
-        '¬©': 'é',   # 另一种编码错误
-        '¬´': 'ó',
-        '¬≠': 'í',
-    }
-    
-    # 按长度排序，先替换长的（避免部分替换问题）
-    for wrong, correct in sorted(replacements.items(), key=lambda x: len(x[0]), reverse=True):
-        text = text.replace(wrong, correct)
+
+def fix_with_table(text):
+    """用映射表修复编解码器无法还原的残留错误"""
+    text = ENCODING_PATTERN.sub(_replace_match, text)
     
     # 特殊处理：Ø 字符（挪威/丹麦语的合法字符，但在某些情况下是错误编码）
     # 只在特定上下文中替换（如 "Dio√Øla" → "Dioîla"）
@@ -61,6 +77,28 @@ def fix_encoding_errors(text):
     
     return text
 
+def fix_encoding_errors(text):
+    """修复常见的编码错误 - UTF-8被误解析为Mac Roman"""
+    if pd.isna(text):
+        return text
+    
+    text = decode_mojibake(str(text))
+    if ENCODING_PATTERN.search(text):
+        text = fix_with_table(text)
+    return text
+
+def fix_encoding_series(series):
+    """整列修复：先逐值用编解码器还原，仍有残留的再用映射表批量替换（缺失值保持不变）"""
+    fixed = series.map(lambda text: decode_mojibake(str(text)), na_action='ignore')
+    leftover = fixed.str.contains(ENCODING_PATTERN, na=False)
+    if leftover.any():
+        fixed[leftover] = (
+            fixed[leftover]
+            .str.replace(ENCODING_PATTERN, _replace_match, regex=True)
+            .str.replace('Dio√Øla', 'Dioïla', regex=False)
+        )
+    return fixed
+
 def main():
     print("=" * 60)
     print("🔧 编码错误修复工具")
@@ -77,7 +115,7 @@ def main():
     all_locations_before = set(list(df['source_nam'].dropna()) + list(df['destination_name'].dropna()))
     
     # 检测多种编码错误标记
-    error_markers = ['√', '¢', '¥', '©', '®', '≠']
+    error_markers = ERROR_MARKERS
     problem_locations_before = [
         loc for loc in all_locations_before 
         if any(marker in str(loc) for marker in error_markers)
@@ -113,10 +151,13 @@ def main():
     total_after = 0
     
     for col in text_columns:
-        before_count = df[col].astype(str).str.contains('|'.join(error_markers), regex=True, na=False).sum()
+        # 每列只扫描一次，得到有问题的行，只修复这些行
+        mask = df[col].str.contains(ERROR_MARKER_PATTERN, na=False)
+        before_count = mask.sum()
         if before_count > 0:  # 只处理有问题的列
-            df[col] = df[col].apply(fix_encoding_errors)
-            after_count = df[col].astype(str).str.contains('|'.join(error_markers), regex=True, na=False).sum()
+            fixed_values = fix_encoding_series(df.loc[mask, col])
+            df.loc[mask, col] = fixed_values
+            after_count = fixed_values.str.contains(ERROR_MARKER_PATTERN, na=False).sum()
             fixed = before_count - after_count
             total_before += before_count
             total_after += after_count
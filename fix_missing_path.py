@@ -4,93 +4,188 @@
 """
 
 import json
+import os
+import threading
+import numpy as np
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+MAX_WORKERS = 8          # 并发请求数（OSRM是网络I/O瓶颈）
+REQUEST_INTERVAL = 0.2   # 限流：所有线程合计，两次请求之间至少间隔（秒）
+
+OSRM_URL = 'http://router.project-osrm.org'
+
+# 全局共享的 Session：连接池复用 TCP 连接（keep-alive），避免每条路线重新握手
+# 超时/连接错误和 502/503/504 自动重试，退避 2s → 4s → 8s
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=2, status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+
+# OSRM路径缓存（按坐标三元组，跨次运行复用；中断后重跑不会重复请求）
+# 运行中新路线逐行追加到日志文件，结束时才合并重写一次 CACHE_FILE（不再每50条重写整个缓存）
+ROUTE_CACHE = {}
+CACHE_FILE = 'osrm_path_cache.json'
+CACHE_LOG_FILE = CACHE_FILE + '.log'
+CACHE_SAVE_EVERY = 50    # 每完成多少条路线把日志刷到磁盘
+
+def route_cache_key(source_coords, via_coords, dest_coords):
+    """坐标三元组 → 缓存键（保留5位小数，约1米）"""
+    return ';'.join(f"{round(c[0], 5)},{round(c[1], 5)}" for c in (source_coords, via_coords, dest_coords))
+
+def load_route_cache():
+    """加载OSRM路径缓存，再重放上次未合并的追加日志"""
+    global ROUTE_CACHE
+    if os.path.exists(CACHE_FILE):
+        ROUTE_CACHE = load_json(CACHE_FILE)
+    if os.path.exists(CACHE_LOG_FILE):
+        with open(CACHE_LOG_FILE, 'rb') as f:
+            for line in f:
+                try:
+                    ROUTE_CACHE.update(orjson.loads(line) if orjson is not None else json.loads(line))
+                except ValueError:  # 中断时写了一半的最后一行
+                    pass
+    if ROUTE_CACHE:
+        print(f"✓ Loaded {len(ROUTE_CACHE)} cached routes")
+    return ROUTE_CACHE
+
+def append_route_cache(log_file, cache_key, result):
+    """新路线追加一行到缓存日志（每行一个 {缓存键: 结果}）"""
+    entry = {cache_key: result}
+    log_file.write(orjson.dumps(entry) if orjson is not None else json.dumps(entry).encode('utf-8'))
+    log_file.write(b'\n')
+
+def save_route_cache():
+    """合并缓存：整个缓存重写一次（只给程序读取，不缩进），然后删除追加日志"""
+    save_json(ROUTE_CACHE, CACHE_FILE, indent=False)
+    if os.path.exists(CACHE_LOG_FILE):
+        os.remove(CACHE_LOG_FILE)
+    print(f"💾 Saved {len(ROUTE_CACHE)} routes to cache")
+
+class RateLimiter:
+    """线程安全的全局限流器：保证所有线程发出的请求之间至少间隔 interval 秒"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+def load_json(filename):
+    """读取JSON文件（优先使用 orjson）"""
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_json(data, filename, indent=True):
+    """
+    保存JSON文件（优先使用 orjson，输出同样为UTF-8；indent=False 时写紧凑格式，用于缓存文件）
+    先写临时文件再替换，中途中断（Ctrl+C）也不会留下写了一半的文件
+    """
+    tmp_file = filename + '.tmp'
+    if orjson is not None:
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0))
+    else:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            if indent:
+                json.dump(data, f, indent=2, ensure_ascii=False, check_circular=False)
+            else:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'), check_circular=False)
+    os.replace(tmp_file, filename)
 
 def simplify_path(points, epsilon=0.001):
-    """Douglas-Peucker 算法简化路径"""
+    """Douglas-Peucker 算法简化路径（NumPy 向量化 + 显式栈，结果与递归版相同）"""
     if len(points) < 3:
         return points
     
-    def perpendicular_distance(point, line_start, line_end):
-        x0, y0 = point
-        x1, y1 = line_start
-        x2, y2 = line_end
+    pts = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[0] = keep[-1] = True
+    
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        
+        # 一次性计算中间所有点到线段 start-end 的距离
+        x1, y1 = pts[start]
+        x2, y2 = pts[end]
+        inner = pts[start + 1:end]
         dx = x2 - x1
         dy = y2 - y1
         if dx == 0 and dy == 0:
-            return ((x0 - x1)**2 + (y0 - y1)**2)**0.5
-        t = max(0, min(1, ((x0 - x1) * dx + (y0 - y1) * dy) / (dx * dx + dy * dy)))
-        proj_x = x1 + t * dx
-        proj_y = y1 + t * dy
-        return ((x0 - proj_x)**2 + (y0 - proj_y)**2)**0.5
-    
-    def rdp(points, epsilon):
-        if len(points) < 3:
-            return points
-        max_dist = 0
-        max_index = 0
-        for i in range(1, len(points) - 1):
-            dist = perpendicular_distance(points[i], points[0], points[-1])
-            if dist > max_dist:
-                max_dist = dist
-                max_index = i
-        if max_dist > epsilon:
-            left = rdp(points[:max_index + 1], epsilon)
-            right = rdp(points[max_index:], epsilon)
-            return left[:-1] + right
+            dist = np.sqrt((inner[:, 0] - x1)**2 + (inner[:, 1] - y1)**2)
         else:
-            return [points[0], points[-1]]
-    
-    return rdp(points, epsilon)
-
-def get_osrm_route(source_coords, via_coords, dest_coords, max_retries=3):
-    """获取 OSRM 路径（带重试）"""
-    for attempt in range(max_retries):
-        try:
-            coords_str = f"{source_coords[0]},{source_coords[1]};{via_coords[0]},{via_coords[1]};{dest_coords[0]},{dest_coords[1]}"
-            url = f"http://router.project-osrm.org/route/v1/driving/{coords_str}"
-            params = {
-                'overview': 'full',
-                'geometries': 'geojson'
-            }
-            
-            response = requests.get(url, params=params, timeout=20)
-            
-            if response.ok:
-                data = response.json()
-                if data.get('routes'):
-                    route = data['routes'][0]
-                    return {
-                        'path': route['geometry']['coordinates'],
-                        'distance_km': route['distance'] / 1000,
-                        'duration_hours': route['duration'] / 3600
-                    }
-            
-            if response.status_code >= 400:
-                return None
-                
-        except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 2
-                print(f"   Timeout, retrying in {wait_time}s... (attempt {attempt + 2}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return None
-                
-        except Exception as e:
-            print(f"   Error: {e}")
-            return None
+            t = np.clip(((inner[:, 0] - x1) * dx + (inner[:, 1] - y1) * dy) / (dx * dx + dy * dy), 0, 1)
+            dist = np.sqrt((inner[:, 0] - (x1 + t * dx))**2 + (inner[:, 1] - (y1 + t * dy))**2)
+        
+        max_index = int(np.argmax(dist))
+        if dist[max_index] > epsilon:
+            max_index += start + 1
+            keep[max_index] = True
+            stack.append((start, max_index))
+            stack.append((max_index, end))
+    
+    return pts[keep].tolist()
+
+def round_path(points, decimals=5):
+    """路径坐标保留5位小数（约1米），与 process_rural_urban_analysis 输出一致"""
+    return [[round(x, decimals), round(y, decimals)] for x, y in points]
+
+def get_osrm_route(source_coords, via_coords, dest_coords):
+    """获取 OSRM 路径（重试由 SESSION 的 Retry 负责）"""
+    try:
+        coords_str = f"{source_coords[0]},{source_coords[1]};{via_coords[0]},{via_coords[1]};{dest_coords[0]},{dest_coords[1]}"
+        url = f"{OSRM_URL}/route/v1/driving/{coords_str}"
+        params = {
+            'overview': 'full',
+            'geometries': 'geojson'
+        }
+        
+        response = SESSION.get(url, params=params, timeout=20)
+        
+        if response.ok:
+            data = response.json()
+            if data.get('routes'):
+                route = data['routes'][0]
+                return {
+                    'path': route['geometry']['coordinates'],
+                    'distance_km': route['distance'] / 1000,
+                    'duration_hours': route['duration'] / 3600
+                }
+        
+        return None
     
-    return None
+    except Exception as e:
+        print(f"   Error: {e}")
+        return None
 
 def main():
     filename = 'food_flows_by_year_round1.json'
     
     print(f"Loading {filename}...")
-    with open(filename, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = load_json(filename)
     
     # 查找缺失路径的路线
     print("\nSearching for routes without paths...")
@@ -112,46 +207,98 @@ def main():
         print("✅ All routes already have paths!")
         return
     
-    # 处理缺失的路线
-    print(f"\nProcessing {len(missing_routes)} missing routes...\n")
-    
-    for i, item in enumerate(missing_routes, 1):
-        year = item['year']
-        route_id = item['route_id']
+    # 同一条路线（起点/中转/终点坐标相同）在不同年份会重复出现，只请求一次
+    route_groups = {}
+    for item in missing_routes:
         route = item['route']
-        
-        source_coords = route['source']['coordinates']
-        via_coords = route['via_city']['coordinates']
-        dest_coords = route['destination']['coordinates']
-        
-        print(f"{i}/{len(missing_routes)}: {route['source']['name']} → {route['via_city']['name']} → {route['destination']['name']}")
-        
-        # 获取路径
-        osrm_result = get_osrm_route(source_coords, via_coords, dest_coords)
-        
-        if osrm_result:
-            # 简化路径
-            original_points = len(osrm_result['path'])
-            simplified_path = simplify_path(osrm_result['path'], epsilon=0.001)
-            
-            # 添加到数据
-            data[year][route_id]['path'] = simplified_path
-            data[year][route_id]['distance_km'] = osrm_result['distance_km']
-            data[year][route_id]['duration_hours'] = osrm_result['duration_hours']
-            
-            print(f"   ✓ Success! Path simplified: {original_points} → {len(simplified_path)} points")
-        else:
-            print(f"   ✗ Failed - will use straight line")
-        
-        time.sleep(0.2)  # 限流
+        key = (
+            tuple(route['source']['coordinates']),
+            tuple(route['via_city']['coordinates']),
+            tuple(route['destination']['coordinates'])
+        )
+        route_groups.setdefault(key, []).append(item)
+    
+    unique_routes = list(route_groups.values())
+    
+    # 处理缺失的路线（多线程并发请求，全局限流）
+    print(f"\nProcessing {len(unique_routes)} unique routes ({len(missing_routes)} missing) with {MAX_WORKERS} workers...\n")
+    
+    load_route_cache()
+    limiter = RateLimiter(REQUEST_INTERVAL)
+    
+    def fetch(items):
+        route = items[0]['route']
+        coords = (
+            route['source']['coordinates'],
+            route['via_city']['coordinates'],
+            route['destination']['coordinates']
+        )
+        cache_key = route_cache_key(*coords)
+        if cache_key in ROUTE_CACHE:  # 缓存命中：不请求、不限流
+            return cache_key, ROUTE_CACHE[cache_key]
+        limiter.wait()
+        return cache_key, get_osrm_route(*coords)
+    
+    new_results = 0
+    dirty_years = set()  # 有路线被补全的年份
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, open(CACHE_LOG_FILE, 'ab') as cache_log:
+            results = executor.map(fetch, unique_routes)
+            for i, (items, (cache_key, osrm_result)) in enumerate(zip(unique_routes, results), 1):
+                # 只缓存成功的结果，失败的路线下次重跑时再请求
+                if osrm_result and cache_key not in ROUTE_CACHE:
+                    ROUTE_CACHE[cache_key] = osrm_result
+                    append_route_cache(cache_log, cache_key, osrm_result)
+                    new_results += 1
+                    if new_results % CACHE_SAVE_EVERY == 0:
+                        cache_log.flush()
+                if process_result(data, items, osrm_result, i, len(unique_routes)):
+                    dirty_years.update(item['year'] for item in items)
+    finally:
+        # 即使中途中断，已获取的路径也已写入日志；合并进缓存文件（日志为空时直接删除）
+        if os.path.exists(CACHE_LOG_FILE):
+            if os.path.getsize(CACHE_LOG_FILE):
+                save_route_cache()
+            else:
+                os.remove(CACHE_LOG_FILE)
+    
+    # 没有任何路线被补全时不重写整个文件（index.html 只读取这一个文件，所以不拆分年份）
+    if not dirty_years:
+        print(f"\nNo routes updated, {filename} left unchanged")
+        return
     
     # 保存更新后的文件
-    print(f"\nSaving updated {filename}...")
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    print(f"\nSaving updated {filename} (years changed: {', '.join(sorted(dirty_years))})...")
+    save_json(data, filename, indent=False)  # 与 process_rural_urban_analysis 输出一致：紧凑JSON
     
     print("✅ Done!")
 
+def process_result(data, items, osrm_result, i, total):
+    """简化 OSRM 返回的路径并写回该路线出现的所有年份，返回是否成功"""
+    route = items[0]['route']
+    
+    print(f"{i}/{total}: {route['source']['name']} → {route['via_city']['name']} → {route['destination']['name']} ({len(items)} years)")
+    
+    if osrm_result:
+        # 简化路径
+        original_points = len(osrm_result['path'])
+        simplified_path = round_path(simplify_path(osrm_result['path'], epsilon=0.001))
+        distance_km = round(osrm_result['distance_km'], 2)
+        duration_hours = round(osrm_result['duration_hours'], 3)
+        
+        # 添加到数据
+        for item in items:
+            target = data[item['year']][item['route_id']]
+            target['path'] = simplified_path
+            target['distance_km'] = distance_km
+            target['duration_hours'] = duration_hours
+        
+        print(f"   ✓ Success! Path simplified: {original_points} → {len(simplified_path)} points")
+        return True
+    
+    print(f"   ✗ Failed - will use straight line")
+    return False
+
 if __name__ == '__main__':
     main()
 
@@ -11,7 +11,7 @@ USAGE:
   With OSRM (top 100):      python process_rural_urban_analysis.py --osrm --top100
 
 CRASH RECOVERY:
-  - OSRM cache is saved every 50 routes to 'osrm_route_cache.json'
+  - OSRM cache: new routes are written every 50 routes to 'osrm_route_cache_round1.sqlite'
   - Progress is tracked in 'osrm_progress.json'
   - Intermediate results saved to '*_temp.json'
   - If interrupted (Ctrl+C or crash), simply run the same command again
@@ -26,34 +26,109 @@ FEATURES:
 """
 
 import pandas as pd
+import numpy as np
 import json
 import requests
+import sqlite3
+import threading
 import time
 import os
 import sys
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 
-# OSRM路径缓存
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+MAX_WORKERS = 8          # OSRM并发请求数（网络I/O瓶颈）
+MAX_IN_FLIGHT = MAX_WORKERS * 4  # 已提交但主线程尚未取走的路线数上限（背压）
+REQUEST_INTERVAL = 0.1   # 限流：所有线程合计，两次请求之间至少间隔（秒）
+
+# 全局共享的 Session：连接池复用 TCP 连接（keep-alive），避免每条路线重新握手
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+CONNECT_TIMEOUT = 5      # 建立连接的超时（秒）：服务器不可达时尽快失败，读取超时另设（OSRM计算路线需要时间）
+
+# OSRM路径缓存（SQLite，每条路线一行：保存时只写入新获取的路线，不再重写整个缓存）
+# 内存中保存编码后的字节串，命中时才解码（坐标展开成Python列表后约占6-7倍内存）
 ROUTE_CACHE = {}
-CACHE_FILE = 'osrm_route_cache_round1.json'  # round1 专用缓存
+NEW_ROUTES = {}          # 尚未写入数据库的新路线
+CACHE_LOCK = threading.Lock()
+CACHE_FILE = 'osrm_route_cache_round1.sqlite'  # round1 专用缓存
+LEGACY_CACHE_FILE = 'osrm_route_cache_round1.json'  # 旧版JSON缓存，首次运行时导入
+COORD_SCALE = 10**6      # OSRM 坐标本身是 1e-6 度的整数，按此精度存为整数不丢失信息
 PROGRESS_FILE = 'osrm_progress_round1.json'  # round1 专用进度
+TEMP_FILE = 'food_flows_by_year_round1_temp.json'  # round1 专用中间结果（--osrm 中断后据此恢复）
+
+def encode_route(result):
+    """
+    单条路线 → 紧凑JSON（存入数据库）
+    路径坐标能精确还原时存为 1e-6 度的整数（'path_e6'），比浮点数文本短，解析也更快
+    """
+    pts = np.asarray(result['path'], dtype=np.float64)
+    scaled = np.rint(pts * COORD_SCALE)
+    if np.array_equal(scaled / COORD_SCALE, pts):
+        result = {key: value for key, value in result.items() if key != 'path'}
+        result['path_e6'] = scaled.astype(np.int64).tolist()
+    return orjson.dumps(result) if orjson is not None else json.dumps(result)
+
+def decode_route(data):
+    """数据库中的JSON → 单条路线（整数坐标还原为度）"""
+    result = orjson.loads(data) if orjson is not None else json.loads(data)
+    if 'path_e6' in result:
+        result['path'] = (np.asarray(result.pop('path_e6'), dtype=np.float64) / COORD_SCALE).tolist()
+    return result
+
+def open_route_cache():
+    """打开缓存数据库（WAL模式，中途中断也不会损坏已写入的数据）"""
+    conn = sqlite3.connect(CACHE_FILE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS routes (id TEXT PRIMARY KEY, data BLOB)')
+    return conn
 
 def load_route_cache():
     """加载OSRM路径缓存"""
     global ROUTE_CACHE
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r') as f:
-            ROUTE_CACHE = json.load(f)
+    with closing(open_route_cache()) as conn:
+        # 数据库为空且有旧版JSON缓存时，先导入一次
+        if os.path.exists(LEGACY_CACHE_FILE) and conn.execute('SELECT COUNT(*) FROM routes').fetchone()[0] == 0:
+            legacy = load_json(LEGACY_CACHE_FILE)
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO routes VALUES (?, ?)',
+                    ((route_id, encode_route(result)) for route_id, result in legacy.items())
+                )
+            print(f"✓ Imported {len(legacy)} routes from {LEGACY_CACHE_FILE}")
+        ROUTE_CACHE = dict(conn.execute('SELECT id, data FROM routes'))
+    if ROUTE_CACHE:
         print(f"✓ Loaded {len(ROUTE_CACHE)} cached routes")
     return ROUTE_CACHE
 
+def cache_route(cache_key, result):
+    """记录新获取的路线（工作线程调用），下次 save_route_cache 时写入数据库"""
+    data = encode_route(result)
+    with CACHE_LOCK:
+        ROUTE_CACHE[cache_key] = data
+        NEW_ROUTES[cache_key] = data
+
 def save_route_cache():
-    """保存OSRM路径缓存"""
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(ROUTE_CACHE, f, indent=2)
-    print(f"💾 Saved {len(ROUTE_CACHE)} routes to cache")
+    """把新获取的路线在一个事务中批量写入缓存数据库"""
+    with CACHE_LOCK:
+        new_routes = dict(NEW_ROUTES)
+        NEW_ROUTES.clear()
+    if new_routes:
+        with closing(open_route_cache()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO routes VALUES (?, ?)',
+                new_routes.items()
+            )
+    print(f"💾 Saved {len(new_routes)} new routes to cache ({len(ROUTE_CACHE)} total)")
 
 def load_progress():
     """加载处理进度"""
@@ -75,70 +150,131 @@ def save_progress(processed, total, last_route_id):
     with open(PROGRESS_FILE, 'w') as f:
         json.dump(progress, f, indent=2)
 
-def save_intermediate_results(data, filename='food_flows_by_year_temp.json'):
-    """保存中间结果（防止数据丢失）"""
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+JSON_WRITE_BUFFER = 1 << 20  # 写文件缓冲区 1MB，减少小块写入的系统调用
+
+def load_json(filename):
+    """读取JSON文件（优先使用 orjson）"""
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def json_default(obj):
+    """json.dump 不支持的 numpy 对象（没有 orjson 时使用）"""
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == np.float32:  # float32 路径坐标按输出精度还原，与 orjson 的输出一致
+            return np.round(obj.astype(np.float64), PATH_DECIMALS).tolist()
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def save_json(data, filename, indent=True):
+    """
+    写出JSON：优先用 orjson 编码为字节（输出与 json.dump 的2空格缩进UTF-8相同，numpy 标量直接序列化）
+    顶层是字典时按键（年份）逐个编码写入，内存中只保留一个键的JSON文本
+    indent=False 时写紧凑JSON（中间结果和最终输出都用，文件约小一半，编码也更快）
+    没有 orjson 时用 json.dump 流式写入（数据是树形结构，跳过循环引用检查，编码快约1/3）
+    先写临时文件再替换，写到一半中断也不会损坏已有文件
+    """
+    tmp_file = filename + '.tmp'
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(tmp_file, 'wb') as f:
+            if isinstance(data, dict) and data:
+                newline = b'\n  ' if indent else b''
+                for i, (key, value) in enumerate(data.items()):
+                    f.write((b'{' if i == 0 else b',') + newline)
+                    f.write(orjson.dumps(str(key)) + (b': ' if indent else b':'))
+                    encoded = orjson.dumps(value, option=option)
+                    # 缩进时子对象整体多缩进一级（字符串中的换行已转义为 \n，不会被误改）
+                    f.write(encoded.replace(b'\n', b'\n  ') if indent else encoded)
+                f.write(b'\n}' if indent else b'}')
+            else:
+                f.write(orjson.dumps(data, option=option))
+    else:
+        with open(tmp_file, 'w', encoding='utf-8', buffering=JSON_WRITE_BUFFER) as f:
+            if indent:
+                json.dump(data, f, indent=2, ensure_ascii=False, check_circular=False, default=json_default)
+            else:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'), check_circular=False, default=json_default)
+    os.replace(tmp_file, filename)
+
+def save_intermediate_results(data, filename=TEMP_FILE):
+    """保存中间结果（防止数据丢失；只用于中断后恢复，写紧凑JSON）"""
+    save_json(data, filename, indent=False)
     print(f"💾 Saved intermediate results to {filename}")
 
 def simplify_path(points, epsilon=0.001):
     """
     使用 Douglas-Peucker 算法简化路径
     epsilon: 简化阈值（度数），0.001 约等于 111 米
+    NumPy 一次算出一段内所有点到线段的距离，显式栈代替递归（结果与逐点递归版相同）
     """
     if len(points) < 3:
         return points
     
-    def perpendicular_distance(point, line_start, line_end):
-        """计算点到线段的垂直距离"""
-        x0, y0 = point
-        x1, y1 = line_start
-        x2, y2 = line_end
+    pts = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[0] = keep[-1] = True
+    
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
         
-        # 线段长度
+        # 中间所有点到线段 start-end 的垂直距离
+        x1, y1 = pts[start]
+        x2, y2 = pts[end]
+        inner = pts[start + 1:end]
         dx = x2 - x1
         dy = y2 - y1
-        
         if dx == 0 and dy == 0:
-            return ((x0 - x1)**2 + (y0 - y1)**2)**0.5
-        
-        # 点到线的距离
-        t = max(0, min(1, ((x0 - x1) * dx + (y0 - y1) * dy) / (dx * dx + dy * dy)))
-        proj_x = x1 + t * dx
-        proj_y = y1 + t * dy
-        
-        return ((x0 - proj_x)**2 + (y0 - proj_y)**2)**0.5
-    
-    def rdp(points, epsilon):
-        """递归 Douglas-Peucker 算法"""
-        if len(points) < 3:
-            return points
-        
-        # 找到距离起点-终点连线最远的点
-        max_dist = 0
-        max_index = 0
-        
-        for i in range(1, len(points) - 1):
-            dist = perpendicular_distance(points[i], points[0], points[-1])
-            if dist > max_dist:
-                max_dist = dist
-                max_index = i
-        
-        # 如果最大距离大于阈值，递归简化
-        if max_dist > epsilon:
-            left = rdp(points[:max_index + 1], epsilon)
-            right = rdp(points[max_index:], epsilon)
-            return left[:-1] + right
+            dist = np.sqrt((inner[:, 0] - x1)**2 + (inner[:, 1] - y1)**2)
         else:
-            return [points[0], points[-1]]
+            t = np.clip(((inner[:, 0] - x1) * dx + (inner[:, 1] - y1) * dy) / (dx * dx + dy * dy), 0, 1)
+            dist = np.sqrt((inner[:, 0] - (x1 + t * dx))**2 + (inner[:, 1] - (y1 + t * dy))**2)
+        
+        # 距离最远的点（并列时取第一个）超过阈值则保留，并分成两段继续简化
+        max_index = int(np.argmax(dist))
+        if dist[max_index] > epsilon:
+            max_index += start + 1
+            keep[max_index] = True
+            stack.append((start, max_index))
+            stack.append((max_index, end))
     
-    simplified = rdp(points, epsilon)
-    return simplified
+    return pts[keep].tolist()
+
+PATH_DECIMALS = 5  # 输出路径坐标保留5位小数（约1米，远小于简化阈值 0.001 度）
+
+def round_path(points, decimals=PATH_DECIMALS):
+    """
+    路径坐标四舍五入（去掉无意义的尾数，输出JSON更小、前端解析更快）
+    存为 (n, 2) 的 float32 数组：内存约为嵌套列表的1/10，orjson 直接序列化
+    （西非经纬度绝对值 < 32，float32 足以精确还原5位小数，输出与列表相同）
+    """
+    return np.array([[round(x, decimals), round(y, decimals)] for x, y in points], dtype=np.float32).reshape(-1, 2)
+
+def has_path(route):
+    """路线是否已有OSRM路径（路径可能是列表或 float32 数组，不能直接判断真假）"""
+    return route.get('path') is not None and len(route['path']) > 0
+
+PROGRESS_REDRAW_INTERVAL = 0.1  # 进度条最多每0.1秒重绘一次（缓存命中时每秒可处理上千条路线）
+last_progress_draw = 0.0
 
-def print_progress_bar(current, total, success, fail, start_time, prefix='Progress'):
+def print_progress_bar(current, total, success, fail, start_time, prefix='Progress', force=False):
     """
     打印进度条和统计信息
+    距上次重绘不足 PROGRESS_REDRAW_INTERVAL 时跳过（最后一条和 force=True 时总会绘制）
     """
+    global last_progress_draw
+    now = time.monotonic()
+    if not force and current < total and now - last_progress_draw < PROGRESS_REDRAW_INTERVAL:
+        return
+    last_progress_draw = now
+    
     # 计算百分比
     percent = 100 * (current / float(total))
     filled_length = int(50 * current // total)
@@ -162,6 +298,38 @@ def print_progress_bar(current, total, success, fail, start_time, prefix='Progre
     sys.stdout.write(f'\r   {prefix}: |{bar}| {percent:.1f}% ({current}/{total}) {stats} | Speed: {speed_str} | ETA: {eta_str}')
     sys.stdout.flush()
 
+class RateLimiter:
+    """线程安全的全局限流器：保证所有线程发出的请求之间至少间隔 interval 秒"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+# 全局限流器：所有线程、所有实际发出的请求（包括超时重试）共用
+LIMITER = RateLimiter(REQUEST_INTERVAL)
+
+def bounded_map(executor, fn, items, window=MAX_IN_FLIGHT):
+    """
+    与 executor.map 相同，按顺序返回结果；但同时最多只提交 window 个任务
+    （executor.map 一次提交全部任务：前面某条路线很慢时，后面已完成的结果全部堆在内存中）
+    """
+    futures = deque()
+    for item in items:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(fn, item))
+    while futures:
+        yield futures.popleft().result()
+
 def get_osrm_route(source_coords, via_coords, dest_coords, route_id):
     """
     获取经过三点的OSRM路径
@@ -183,7 +351,7 @@ def get_osrm_route(source_coords, via_coords, dest_coords, route_id):
     # 检查缓存
     cache_key = f"{route_id}"
     if cache_key in ROUTE_CACHE:
-        return ROUTE_CACHE[cache_key]
+        return decode_route(ROUTE_CACHE[cache_key])
     
     try:
         # 构建OSRM请求
@@ -194,7 +362,8 @@ def get_osrm_route(source_coords, via_coords, dest_coords, route_id):
             'geometries': 'geojson'
         }
         
-        response = requests.get(url, params=params, timeout=10)
+        LIMITER.wait()  # 缓存命中已在上面返回，只有真正发请求时才限流
+        response = SESSION.get(url, params=params, timeout=(CONNECT_TIMEOUT, 10))
         
         if response.ok:
             data = response.json()
@@ -207,7 +376,7 @@ def get_osrm_route(source_coords, via_coords, dest_coords, route_id):
                 }
                 
                 # 缓存结果
-                ROUTE_CACHE[cache_key] = result
+                cache_route(cache_key, result)
                 return result
         
         print(f"  ⚠️  OSRM failed for route {route_id}: {response.status_code}")
@@ -217,64 +386,186 @@ def get_osrm_route(source_coords, via_coords, dest_coords, route_id):
         print(f"  ❌ Error getting OSRM route {route_id}: {e}")
         return None
 
+# 转为category的字符串列
+CATEGORY_COLUMNS = [
+    'source_nam', 'destination_name', 'city', 'Source_country_name', 'Dest_country_name',
+    'means_of_t', 'commodit_1', 'commodit_2', 'source_wit',
+    'destination_within_urban_boundary', 'Crosses international border?'
+]
+
+# 加载时只读取用到的列（CSV有70多列）：数值列 + 上面的字符串列
+NUMERIC_COLUMNS = ['year', 'Source x', 'Source y', 'Destination x', 'Destination y', 'total_quantity', 'distance_1']
+
+def count_values(series):
+    """
+    value_counts：category列只保留出现过的类别，
+    计数相同时按首次出现的顺序排列
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.value_counts()
+    
+    codes = series.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    uniques, first_seen, counts = np.unique(codes, return_index=True, return_counts=True)
+    order = np.lexsort((first_seen, -counts))
+    return pd.Series(counts[order], index=series.cat.categories[uniques[order]], name='count')
+
+def index_keys(index):
+    """
+    索引 → 分组键列表（Python原生类型，多级索引为元组）
+    按层整列 tolist() 再组合，比逐个遍历 MultiIndex / to_dict 逐行装箱快得多
+    """
+    if index.nlevels == 1:
+        return index.tolist()
+    return list(zip(*(index.get_level_values(i).tolist() for i in range(index.nlevels))))
+
+def ranked_counts(df, by, col):
+    """
+    按 by 分组统计 col 各取值出现的次数（一次groupby完成所有分组）
+    返回 {分组键: {取值: 次数}}，次数从大到小，相同时按首次出现顺序（与 count_values 一致）
+    """
+    counts = (
+        df[by + [col]]
+        .assign(_pos=np.arange(len(df)))
+        .groupby(by + [col], observed=True, sort=False)['_pos']
+        .agg(['size', 'min'])
+        .sort_values(by + ['size', 'min'], ascending=[True] * len(by) + [False, True])
+    )
+    group_keys = index_keys(counts.index.droplevel(-1))
+    values = counts.index.get_level_values(-1).tolist()
+    
+    result = defaultdict(dict)
+    for group_key, value, count in zip(group_keys, values, counts['size'].tolist()):
+        result[group_key][value] = count
+    return result
+
+def unique_values(df, by, col, sort=False):
+    """
+    按 by 分组收集 col 的不重复取值（忽略缺失值）
+    返回 {分组键: [取值, ...]}，默认按首次出现顺序，sort=True 时从小到大
+    """
+    pairs = df[by + [col]].dropna().drop_duplicates()
+    if sort:
+        pairs = pairs.sort_values(by + [col])
+    group_keys = pairs[by[0]].tolist() if len(by) == 1 else zip(*(pairs[b].tolist() for b in by))
+    
+    result = defaultdict(list)
+    for group_key, value in zip(group_keys, pairs[col].tolist()):
+        result[group_key].append(value)
+    return result
+
+def most_common_by(df, by, col):
+    """
+    按 by 分组取 col 的众数（一次groupby完成，等价于各组 mode()[0]：并列时取排序最小的值）
+    返回 {分组键: 众数}，col全部缺失的分组不在结果中
+    """
+    # 分组结果随后整体排序，groupby本身不必排序
+    counts = df.groupby([by, col], observed=True, sort=False).size().reset_index(name='count')
+    top = counts.sort_values([by, 'count', col], ascending=[True, False, True]).drop_duplicates(by)
+    return dict(zip(top[by].tolist(), top[col].tolist()))
+
+def flow_totals(df, by):
+    """按 by 分组的记录数和总量（总量全部缺失时为0），返回 {分组键: {'flows', 'quantity'}}"""
+    # 一次聚合同时得到记录数和总量（sum 对全部缺失的分组返回0）；结果只用于按键查找，分组顺序无关
+    totals = df.groupby(by, observed=True, sort=False)['total_quantity'].agg(['size', 'sum'])
+    return {
+        key: {'flows': f, 'quantity': q}
+        for key, f, q in zip(index_keys(totals.index), totals['size'].tolist(), totals['sum'].tolist())
+    }
+
+def urban_flag(series):
+    """
+    城乡标记（'yes'/'no'，category列）→ 可空布尔列：'yes'（不区分大小写）为True
+    只对类别做一次字符串比较；缺失值保持缺失，取众数时不参与计数
+    """
+    codes = series.cat.codes.to_numpy()
+    is_yes = series.cat.categories.astype(str).str.lower().to_numpy() == 'yes'
+    return pd.arrays.BooleanArray(is_yes[codes] & (codes >= 0), codes < 0)
+
 def load_and_clean_data(csv_path):
     """Load and clean the full dataset"""
     print("Loading full dataset...")
-    df = pd.read_csv(csv_path, encoding='utf-8-sig', low_memory=False)
+    # 先读表头，只解析用到的列（解析更快，内存约为全表的1/3）；缺少的可选列（如 distance_1）直接跳过
+    header = pd.read_csv(csv_path, encoding='utf-8-sig', nrows=0).columns
+    usecols = [col for col in header if col in NUMERIC_COLUMNS or col in CATEGORY_COLUMNS]
+    try:
+        # PyArrow引擎多线程解析CSV，结果与默认C引擎一致
+        df = pd.read_csv(csv_path, encoding='utf-8-sig', engine='pyarrow', usecols=usecols)
+    except (ImportError, ValueError):
+        # 未安装pyarrow或解析失败时退回默认引擎
+        df = pd.read_csv(csv_path, encoding='utf-8-sig', low_memory=False, usecols=usecols)
     
     # Clean data
     df['year_clean'] = pd.to_numeric(df['year'], errors='coerce')
     df = df[df['year_clean'].between(2013, 2017)]
+    df['year_clean'] = df['year_clean'].astype(int)  # 已过滤掉缺失值，年份直接存为整数
     
     for col in ['Source x', 'Source y', 'Destination x', 'Destination y']:
         df[col] = pd.to_numeric(df[col], errors='coerce')
     
-    df = df.dropna(subset=['Source x', 'Source y', 'Destination x', 'Destination y'])
+    df = df.dropna(subset=['Source x', 'Source y', 'Destination x', 'Destination y']).copy()
+    
+    # 重复的字符串标签转为category，groupby只需比较整数编码，内存也小得多
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    # 缺失值后续会填充为 'direct' / 'Unknown'，先加入类别
+    df['city'] = df['city'].cat.add_categories(['direct'])
+    for col in ['means_of_t', 'commodit_1', 'commodit_2']:
+        df[col] = df[col].cat.add_categories(['Unknown'])
+    # 路线分组用的城市列、细分统计用的交通方式列只在这里填充一次，两个路线构建函数直接使用
+    df['city_grouped'] = df['city'].fillna('direct')
+    df['means_of_t_clean'] = df['means_of_t'].fillna('Unknown')
+    # 路线分组用的舍入坐标（1位小数≈11公里精度，聚合更激进）同样只在这里算一次
+    df['src_x_rounded'] = df['Source x'].round(1)
+    df['src_y_rounded'] = df['Source y'].round(1)
+    df['dest_x_rounded'] = df['Destination x'].round(1)
+    df['dest_y_rounded'] = df['Destination y'].round(1)
+    
+    # 城乡属性只在加载时解析一次，后续分类和路线统计直接使用布尔列
+    df['source_is_urban'] = urban_flag(df['source_wit'])
+    df['dest_is_urban'] = urban_flag(df['destination_within_urban_boundary'])
+    # 是否跨境同样只比较一次（category列只比较类别）
+    df['is_intl_border'] = df['Crosses international border?'].eq('YES').to_numpy()
     
     print(f"Loaded {len(df)} records")
     return df
 
-def classify_flow_type(source_urban, dest_urban):
+# 按字母顺序排列，category编码顺序与字符串排序一致（groupby输出顺序不变）
+# 编码恰好是两位二进制：(起点是否城市 << 1) | 终点是否城市
+FLOW_TYPES = ['rural_to_rural', 'rural_to_urban', 'urban_to_rural', 'urban_to_urban']
+
+FLOW_TYPE_LABELS = {
+    'rural_to_urban': 'Rural → Urban',
+    'urban_to_rural': 'Urban → Rural',
+    'rural_to_rural': 'Rural → Rural',
+    'urban_to_urban': 'Urban → Urban'
+}
+
+def classify_flow_type(source_is_urban, dest_is_urban):
     """
-    Classify flow type based on rural/urban status
+    Classify flow type based on rural/urban status (vectorized over whole columns)
     """
-    source_is_urban = str(source_urban).lower() == 'yes'
-    dest_is_urban = str(dest_urban).lower() == 'yes'
-    
-    if source_is_urban and dest_is_urban:
-        return 'urban_to_urban'
-    elif source_is_urban and not dest_is_urban:
-        return 'urban_to_rural'
-    elif not source_is_urban and dest_is_urban:
-        return 'rural_to_urban'
-    else:
-        return 'rural_to_rural'
+    # 缺失的城乡属性按农村处理
+    source_is_urban = source_is_urban.to_numpy(dtype=bool, na_value=False)
+    dest_is_urban = dest_is_urban.to_numpy(dtype=bool, na_value=False)
+    
+    # 无分支：直接由两个布尔值拼出类别编码，不生成中间字符串数组
+    codes = (source_is_urban.astype(np.int8) << 1) | dest_is_urban.astype(np.int8)
+    return pd.Categorical.from_codes(codes, categories=FLOW_TYPES)
 
 def get_flow_type_label(flow_type):
     """Get human-readable label"""
-    labels = {
-        'rural_to_urban': 'Rural → Urban',
-        'urban_to_rural': 'Urban → Rural',
-        'rural_to_rural': 'Rural → Rural',
-        'urban_to_urban': 'Urban → Urban'
-    }
-    return labels.get(flow_type, 'Unknown')
+    return FLOW_TYPE_LABELS.get(flow_type, 'Unknown')
 
 def analyze_rural_urban_patterns(df):
     """Analyze rural-urban flow patterns"""
     print("\nAnalyzing rural-urban patterns...")
     
     # Add flow type classification
-    df['flow_type'] = df.apply(
-        lambda row: classify_flow_type(
-            row['source_wit'], 
-            row['destination_within_urban_boundary']
-        ), 
-        axis=1
-    )
+    df['flow_type'] = classify_flow_type(df['source_is_urban'], df['dest_is_urban'])
     
     # Overall statistics
-    flow_type_counts = df['flow_type'].value_counts().to_dict()
+    flow_type_counts = count_values(df['flow_type']).to_dict()
     
     analysis = {
         'total_flows': len(df),
@@ -283,15 +574,17 @@ def analyze_rural_urban_patterns(df):
     
     for flow_type, count in flow_type_counts.items():
         flow_df = df[df['flow_type'] == flow_type]
+        # 全部缺失时 sum(min_count=1) 为NaN，只需扫描一遍
+        total_quantity = flow_df['total_quantity'].sum(min_count=1)
         
         analysis['flow_patterns'][flow_type] = {
             'label': get_flow_type_label(flow_type),
             'count': int(count),
             'percentage': round(count / len(df) * 100, 2),
-            'total_quantity': float(flow_df['total_quantity'].sum()) if not flow_df['total_quantity'].isna().all() else 0,
+            'total_quantity': float(total_quantity) if pd.notna(total_quantity) else 0,
             'avg_distance': float(flow_df['distance_1'].mean()) if 'distance_1' in flow_df else 0,
-            'international_count': int(len(flow_df[flow_df['Crosses international border?'] == 'YES'])),
-            'top_commodities': flow_df['commodit_1'].value_counts().head(5).to_dict()
+            'international_count': int(flow_df['is_intl_border'].sum()),
+            'top_commodities': count_values(flow_df['commodit_1']).head(5).to_dict()
         }
     
     return analysis, df
@@ -307,177 +600,206 @@ def build_city_coordinates_lookup(df):
     # Get unique cities
     unique_cities = df['city'].dropna().unique()
     
+    # 地名各编码一次：子串匹配只在唯一地名上做，再按编码选出匹配的记录
+    # 地名预先统一转小写，匹配时用普通子串查找（不区分大小写的正则每次都要重新编译和转换）
+    source_codes, source_names = pd.factorize(df['source_nam'])
+    dest_codes, dest_names = pd.factorize(df['destination_name'])
+    source_names = pd.Series(source_names).str.lower()
+    dest_names = pd.Series(dest_names).str.lower()
+    
+    def find_matches(codes, names, city):
+        matched_names = np.flatnonzero(names.str.contains(city.lower(), regex=False, na=False).to_numpy())
+        return np.isin(codes, matched_names)
+    
     for city in unique_cities:
         # Try to find coordinates from source locations
-        source_matches = df[df['source_nam'].str.contains(city, na=False, case=False)]
-        if len(source_matches) > 0:
+        source_matches = find_matches(source_codes, source_names, city)
+        if source_matches.any():
             # Use median coordinates for robustness
             coords = [
-                float(source_matches['Source x'].median()),
-                float(source_matches['Source y'].median())
+                float(df.loc[source_matches, 'Source x'].median()),
+                float(df.loc[source_matches, 'Source y'].median())
             ]
             city_coords[city] = coords
             continue
         
         # Try to find coordinates from destination locations
-        dest_matches = df[df['destination_name'].str.contains(city, na=False, case=False)]
-        if len(dest_matches) > 0:
+        dest_matches = find_matches(dest_codes, dest_names, city)
+        if dest_matches.any():
             coords = [
-                float(dest_matches['Destination x'].median()),
-                float(dest_matches['Destination y'].median())
+                float(df.loc[dest_matches, 'Destination x'].median()),
+                float(df.loc[dest_matches, 'Destination y'].median())
             ]
             city_coords[city] = coords
     
     print(f"Found coordinates for {len(city_coords)} cities")
     return city_coords
 
-def create_routes_with_rural_urban(df, min_flows=1):
+def create_routes_with_rural_urban(df, city_coords_lookup=None, min_flows=1):
     """
     Create aggregated routes with rural-urban classification
     Includes via_city information for three-point routes (source -> city -> destination)
+    city_coords_lookup: 中转城市坐标表（与 create_hierarchical_data_by_year 共用；None 时自行构建）
     """
     print(f"Creating routes with rural-urban info (min {min_flows} flows)...")
     
     # Build city coordinates lookup
-    city_coords_lookup = build_city_coordinates_lookup(df)
+    if city_coords_lookup is None:
+        city_coords_lookup = build_city_coordinates_lookup(df)
+    
+    # 只保留路线统计用到的列（CSV有70多列），后续排序和分组搬动的数据少得多
+    needed = [
+        'src_x_rounded', 'src_y_rounded', 'dest_x_rounded', 'dest_y_rounded',
+        'city_grouped', 'flow_type', 'year_clean', 'total_quantity',
+        'source_nam', 'destination_name', 'Source_country_name', 'Dest_country_name',
+        'source_is_urban', 'dest_is_urban', 'means_of_t', 'means_of_t_clean', 'commodit_1', 'commodit_2'
+    ]
+    df = df[needed].copy()
     
     routes = []
     
     # === 按三点路线聚合: 以坐标为准（名字可重复）===
     # 坐标舍入到小数点后1位（约11公里精度），聚合附近的点
     
-    # Add city to grouping (using fillna to handle missing values)
-    df['city_grouped'] = df['city'].fillna('direct')
+    # 分组键只需区分舍入后的坐标，用 float32 存储（分组时扫描的字节减半）
+    coord_keys = ['src_x_rounded', 'src_y_rounded', 'dest_x_rounded', 'dest_y_rounded']
+    df[coord_keys] = df[coord_keys].astype('float32')
     
-    # Round coordinates for aggregation (1 decimal place ≈ 11km precision)
-    # 更激进的聚合，减少更多路线
-    df['src_x_rounded'] = df['Source x'].round(1)
-    df['src_y_rounded'] = df['Source y'].round(1)
-    df['dest_x_rounded'] = df['Destination x'].round(1)
-    df['dest_y_rounded'] = df['Destination y'].round(1)
+    route_keys = coord_keys + ['city_grouped', 'flow_type']
+    # 先按路线键稳定排序：同一路线的记录在内存中连续，后续按路线分组时顺序扫描即可
+    # 已排好序，groupby 不必再排序（按首次出现编号即为排序后的顺序；路线内记录的先后不变）
+    df = df.sort_values(route_keys, kind='stable').reset_index(drop=True)
+    grouped = df.groupby(route_keys, observed=True, sort=False)
     
-    grouped = df.groupby([
-        'src_x_rounded',
-        'src_y_rounded',
-        'dest_x_rounded',
-        'dest_y_rounded',
-        'city_grouped',
-        'flow_type'
-    ])
+    # 每条路线一个整数编号，路线级统计一次性按编号分组完成，不再逐条路线计算
+    df['route_idx'] = grouped.ngroup()
+    # 路线键、记录数、总量一次聚合得到（行号与 ngroup 编号一致；总量全部缺失时为0）
+    agg_df = grouped['total_quantity'].agg(flows='size', quantity='sum').reset_index()
+    # 输出坐标还原为 float64 的舍入值（float32 精度远高于 1 位小数，再舍入一次即可精确还原）
+    agg_df[coord_keys] = agg_df[coord_keys].astype('float64').round(1)
+    
+    # 名字、国家、城乡属性、主要交通方式取众数（同一坐标可能有多个名字）
+    source_names = most_common_by(df, 'route_idx', 'source_nam')
+    dest_names = most_common_by(df, 'route_idx', 'destination_name')
+    src_countries = most_common_by(df, 'route_idx', 'Source_country_name')
+    dest_countries = most_common_by(df, 'route_idx', 'Dest_country_name')
+    main_transports = most_common_by(df, 'route_idx', 'means_of_t')
+    source_urban = most_common_by(df, 'route_idx', 'source_is_urban')
+    dest_urban = most_common_by(df, 'route_idx', 'dest_is_urban')
+    commodity_counts_by_route = ranked_counts(df, ['route_idx'], 'commodit_1')
+    transport_modes_by_route = ranked_counts(df, ['route_idx'], 'means_of_t')
+    
+    # 商品类别（按首次出现顺序）和年份（排序）
+    categories_by_route = unique_values(df, ['route_idx'], 'commodit_2')
+    years_by_route = unique_values(df, ['route_idx'], 'year_clean', sort=True)
     
-    for key, route_df in grouped:
-        src_x_rounded, src_y_rounded, dest_x_rounded, dest_y_rounded, city_name, flow_type = key
+    # 细分统计（按年份 / 交通方式 / 商品）同样用多列分组一次算完
+    year_totals = flow_totals(df, ['route_idx', 'year_clean'])
+    year_commodities = ranked_counts(df, ['route_idx', 'year_clean'], 'commodit_1')
+    year_transport = ranked_counts(df, ['route_idx', 'year_clean'], 'means_of_t_clean')
+    
+    transport_counts = ranked_counts(df, ['route_idx'], 'means_of_t_clean')
+    transport_totals = flow_totals(df, ['route_idx', 'means_of_t_clean'])
+    transport_years = unique_values(df, ['route_idx', 'means_of_t_clean'], 'year_clean', sort=True)
+    transport_commodities = ranked_counts(df, ['route_idx', 'means_of_t_clean'], 'commodit_1')
+    
+    commodity_totals = flow_totals(df, ['route_idx', 'commodit_1'])
+    commodity_years = unique_values(df, ['route_idx', 'commodit_1'], 'year_clean', sort=True)
+    commodity_transport = ranked_counts(df, ['route_idx', 'commodit_1'], 'means_of_t_clean')
+    
+    for row in agg_df.itertuples():
+        city_name = row.city_grouped
+        flow_type = row.flow_type
         
-        if len(route_df) < min_flows:
+        if row.flows < min_flows:
             continue
         
         # 使用舍入后的坐标（作为唯一标识）
-        src_x = src_x_rounded
-        src_y = src_y_rounded
-        dest_x = dest_x_rounded
-        dest_y = dest_y_rounded
+        src_x = row.src_x_rounded
+        src_y = row.src_y_rounded
+        dest_x = row.dest_x_rounded
+        dest_y = row.dest_y_rounded
         
         # 获取名字（取众数，因为同一坐标可能有多个名字）
-        source_name = route_df['source_nam'].mode()[0] if len(route_df['source_nam'].mode()) > 0 else 'Unknown'
-        dest_name = route_df['destination_name'].mode()[0] if len(route_df['destination_name'].mode()) > 0 else 'Unknown'
+        source_name = source_names.get(row.Index, 'Unknown')
+        dest_name = dest_names.get(row.Index, 'Unknown')
         
-        src_country = route_df['Source_country_name'].mode()[0] if len(route_df['Source_country_name'].mode()) > 0 else 'Unknown'
-        dest_country = route_df['Dest_country_name'].mode()[0] if len(route_df['Dest_country_name'].mode()) > 0 else 'Unknown'
+        src_country = src_countries.get(row.Index, 'Unknown')
+        dest_country = dest_countries.get(row.Index, 'Unknown')
         
-        total_flows = len(route_df)
-        total_quantity = float(route_df['total_quantity'].sum()) if not route_df['total_quantity'].isna().all() else 0
+        total_flows = row.flows
+        total_quantity = row.quantity
         
-        commodity_counts = route_df['commodit_1'].value_counts().head(5).to_dict()
-        categories = route_df['commodit_2'].dropna().unique().tolist()
-        years = sorted(route_df['year_clean'].dropna().unique().tolist())
+        commodity_counts = dict(list(commodity_counts_by_route[row.Index].items())[:5])
+        categories = categories_by_route[row.Index]
+        years = years_by_route[row.Index]
         
         # Get transportation modes
-        transport_modes = route_df['means_of_t'].value_counts().to_dict()
-        main_transport = route_df['means_of_t'].mode()[0] if len(route_df['means_of_t'].mode()) > 0 else 'Unknown'
+        transport_modes = transport_modes_by_route[row.Index]
+        main_transport = main_transports.get(row.Index, 'Unknown')
         
         # === NEW: Build detailed breakdowns by year and transport mode ===
         # By year breakdown
+        # 以下统计结果均已是Python原生类型（int/float/str），直接放入输出，无需逐个转换
         by_year = {}
         for year in years:
-            year_df = route_df[route_df['year_clean'] == year]
-            year_commodities = year_df['commodit_1'].value_counts().to_dict()
-            # Handle missing transport modes
-            year_df_temp = year_df.copy()
-            year_df_temp['means_of_t_clean'] = year_df_temp['means_of_t'].fillna('Unknown')
-            year_transport = year_df_temp['means_of_t_clean'].value_counts().to_dict()
-            by_year[int(year)] = {
-                'flows': int(len(year_df)),
-                'quantity': float(year_df['total_quantity'].sum()) if not year_df['total_quantity'].isna().all() else 0,
-                'commodities': {str(k): int(v) for k, v in year_commodities.items()},
-                'transport_modes': {str(k): int(v) for k, v in year_transport.items()}
+            key = (row.Index, year)
+            by_year[year] = {
+                'flows': year_totals[key]['flows'],
+                'quantity': year_totals[key]['quantity'],
+                'commodities': year_commodities[key],
+                'transport_modes': year_transport[key]
             }
         
-        # By transport mode breakdown (handle missing values)
+        # By transport mode breakdown (missing values counted as 'Unknown')
         by_transport = {}
-        # Create a temporary column with 'Unknown' for missing transport modes
-        route_df_temp = route_df.copy()
-        route_df_temp['means_of_t_clean'] = route_df_temp['means_of_t'].fillna('Unknown')
-        
-        # Get all transport modes including 'Unknown'
-        all_transport_modes = route_df_temp['means_of_t_clean'].value_counts().to_dict()
-        
-        for transport in all_transport_modes.keys():
-            trans_df = route_df_temp[route_df_temp['means_of_t_clean'] == transport]
-            trans_years = sorted(trans_df['year_clean'].dropna().unique().tolist())
-            trans_commodities = trans_df['commodit_1'].value_counts().to_dict()
-            by_transport[str(transport)] = {
-                'flows': int(len(trans_df)),
-                'quantity': float(trans_df['total_quantity'].sum()) if not trans_df['total_quantity'].isna().all() else 0,
-                'years': [int(y) for y in trans_years],
-                'commodities': {str(k): int(v) for k, v in trans_commodities.items()}
+        for transport in transport_counts[row.Index].keys():
+            key = (row.Index, transport)
+            by_transport[transport] = {
+                'flows': transport_totals[key]['flows'],
+                'quantity': transport_totals[key]['quantity'],
+                'years': transport_years[key],
+                'commodities': transport_commodities[key]
             }
         
         # By commodity breakdown
         by_commodity = {}
         for commodity in commodity_counts.keys():
-            comm_df = route_df[route_df['commodit_1'] == commodity]
-            comm_years = sorted(comm_df['year_clean'].dropna().unique().tolist())
-            # Handle missing transport modes
-            comm_df_temp = comm_df.copy()
-            comm_df_temp['means_of_t_clean'] = comm_df_temp['means_of_t'].fillna('Unknown')
-            comm_transport = comm_df_temp['means_of_t_clean'].value_counts().to_dict()
-            by_commodity[str(commodity)] = {
-                'flows': int(len(comm_df)),
-                'quantity': float(comm_df['total_quantity'].sum()) if not comm_df['total_quantity'].isna().all() else 0,
-                'years': [int(y) for y in comm_years],
-                'transport_modes': {str(k): int(v) for k, v in comm_transport.items()}
+            key = (row.Index, commodity)
+            by_commodity[commodity] = {
+                'flows': commodity_totals[key]['flows'],
+                'quantity': commodity_totals[key]['quantity'],
+                'years': commodity_years[key],
+                'transport_modes': commodity_transport[key]
             }
         
-        is_intl = (src_country != dest_country) if pd.notna(src_country) and pd.notna(dest_country) else False
-        
-        # Determine urban status
-        source_is_urban = route_df['source_wit'].mode()[0] if len(route_df['source_wit'].mode()) > 0 else 'no'
-        dest_is_urban = route_df['destination_within_urban_boundary'].mode()[0] if len(route_df['destination_within_urban_boundary'].mode()) > 0 else 'no'
+        # 国家缺失时已取默认值 'Unknown'
+        is_intl = src_country != dest_country
         
         # Build route object (source_name和dest_name已经从groupby key中获取)
         route = {
             'source': {
-                'name': str(source_name),
-                'country': str(src_country) if pd.notna(src_country) else 'Unknown',
-                'coordinates': [float(src_x), float(src_y)],
-                'is_urban': str(source_is_urban).lower() == 'yes'
+                'name': source_name,
+                'country': src_country,
+                'coordinates': [src_x, src_y],
+                'is_urban': source_urban.get(row.Index, False)
             },
             'destination': {
-                'name': str(dest_name),
-                'country': str(dest_country) if pd.notna(dest_country) else 'Unknown',
-                'coordinates': [float(dest_x), float(dest_y)],
-                'is_urban': str(dest_is_urban).lower() == 'yes'
+                'name': dest_name,
+                'country': dest_country,
+                'coordinates': [dest_x, dest_y],
+                'is_urban': dest_urban.get(row.Index, False)
             },
-            'flows': int(total_flows),
-            'quantity': float(total_quantity),
-            'commodities': {k: int(v) for k, v in commodity_counts.items()},
-            'categories': [str(c) for c in categories],
-            'years': [int(y) for y in years],
-            'transport_modes': {str(k): int(v) for k, v in transport_modes.items()},
-            'main_transport': str(main_transport),
-            'is_international': bool(is_intl),
+            'flows': total_flows,
+            'quantity': total_quantity,
+            'commodities': commodity_counts,
+            'categories': categories,
+            'years': years,
+            'transport_modes': transport_modes,
+            'main_transport': main_transport,
+            'is_international': is_intl,
             'flow_type': flow_type,
-            'flow_type_label': get_flow_type_label(flow_type),
+            'flow_type_label': FLOW_TYPE_LABELS[flow_type],  # flow_type 只可能是 FLOW_TYPES 之一
             # === NEW: Detailed breakdowns for precise filtering ===
             'by_year': by_year,
             'by_transport': by_transport,
@@ -487,17 +809,21 @@ def create_routes_with_rural_urban(df, min_flows=1):
         # Add via_city information if route goes through a city
         if city_name != 'direct' and city_name in city_coords_lookup:
             route['via_city'] = {
-                'name': str(city_name),
+                'name': city_name,
                 'coordinates': city_coords_lookup[city_name]
             }
         
+        # 该路线在 hierarchical_data 中的 route_id（合并OSRM路径时直接使用，不必再逐条舍入坐标、拼接字符串）
+        via_name = route['via_city']['name'] if 'via_city' in route else 'direct'
+        route['route_id'] = f"r_{src_x}_{src_y}_{dest_x}_{dest_y}_{via_name}"
+        
         routes.append(route)
     
     print(f"Created {len(routes)} routes")
     return routes
 
 
-def create_hierarchical_data_by_year(df):
+def create_hierarchical_data_by_year(df, city_coords_lookup=None):
     """
     Create hierarchical data structure organized by year
     
@@ -528,19 +854,14 @@ def create_hierarchical_data_by_year(df):
         }
       }
     }
+    
+    city_coords_lookup: 中转城市坐标表（与 create_routes_with_rural_urban 共用；None 时自行构建）
     """
     print("Creating hierarchical data structure by year...")
     
     # Build city coordinates lookup
-    city_coords_lookup = build_city_coordinates_lookup(df)
-    
-    # Round coordinates for aggregation (1 decimal place ≈ 11km precision)
-    # 更激进的聚合，减少更多路线
-    df['src_x_rounded'] = df['Source x'].round(1)
-    df['src_y_rounded'] = df['Source y'].round(1)
-    df['dest_x_rounded'] = df['Destination x'].round(1)
-    df['dest_y_rounded'] = df['Destination y'].round(1)
-    df['city_grouped'] = df['city'].fillna('direct')
+    if city_coords_lookup is None:
+        city_coords_lookup = build_city_coordinates_lookup(df)
     
     # Result structure: year -> route_id -> data
     data_by_year = defaultdict(dict)
@@ -554,9 +875,43 @@ def create_hierarchical_data_by_year(df):
         'city_grouped',
         'flow_type',
         'year_clean'
-    ])
+    ], observed=True)
+    
+    # 分组级统计（名字/国家/城乡属性取众数，记录数和总量）按分组编号一次性算完，循环中直接查表
+    df['group_idx'] = grouped.ngroup()
+    source_names = most_common_by(df, 'group_idx', 'source_nam')
+    dest_names = most_common_by(df, 'group_idx', 'destination_name')
+    src_countries = most_common_by(df, 'group_idx', 'Source_country_name')
+    dest_countries = most_common_by(df, 'group_idx', 'Dest_country_name')
+    source_urban = most_common_by(df, 'group_idx', 'source_is_urban')
+    dest_urban = most_common_by(df, 'group_idx', 'dest_is_urban')
+    group_totals = flow_totals(df, 'group_idx')
     
-    for key, route_df in grouped:
+    # 商品/运输方式明细按 (分组编号, 商品, 运输方式) 一次聚合，代替逐行 iterrows 累加
+    # 先按分组编号稳定排序，sort=False 保证组内商品、运输方式按首次出现的顺序排列（与逐行累加一致）
+    # 类别取该商品首条记录的值；总量全部缺失时为0，记录数包含总量缺失的行
+    # 填充后仍是category列（加载时已加入 'Unknown' 类别），分组只比较整数编码
+    commodity_details = (
+        df.assign(
+            commodity=df['commodit_1'].fillna('Unknown'),
+            category=df['commodit_2'].fillna('Unknown'),
+            transport=df['means_of_t_clean']
+        )
+        .sort_values('group_idx', kind='stable')
+        .groupby(['group_idx', 'commodity', 'transport'], observed=True, sort=False)
+        .agg(category=('category', 'first'), quantity=('total_quantity', 'sum'), flow=('total_quantity', 'size'))
+    )
+    details_by_group = defaultdict(list)
+    for (idx, commodity, transport), category, quantity, flow in zip(
+        index_keys(commodity_details.index),
+        commodity_details['category'].tolist(),
+        commodity_details['quantity'].tolist(),
+        commodity_details['flow'].tolist()
+    ):
+        details_by_group[idx].append((commodity, category, transport, quantity, flow))
+    
+    # 只遍历分组键，顺序与 ngroup 编号一致（均按分组键排序）
+    for group_idx, key in enumerate(index_keys(grouped.size().index)):
         src_x, src_y, dest_x, dest_y, city_name, flow_type, year = key
         
         if pd.isna(year):
@@ -568,10 +923,10 @@ def create_hierarchical_data_by_year(df):
         route_id = f"r_{src_x}_{src_y}_{dest_x}_{dest_y}_{city_name}"
         
         # Get names (mode = most frequent)
-        source_name = route_df['source_nam'].mode()[0] if len(route_df['source_nam'].mode()) > 0 else 'Unknown'
-        dest_name = route_df['destination_name'].mode()[0] if len(route_df['destination_name'].mode()) > 0 else 'Unknown'
-        src_country = route_df['Source_country_name'].mode()[0] if len(route_df['Source_country_name'].mode()) > 0 else 'Unknown'
-        dest_country = route_df['Dest_country_name'].mode()[0] if len(route_df['Dest_country_name'].mode()) > 0 else 'Unknown'
+        source_name = source_names.get(group_idx, 'Unknown')
+        dest_name = dest_names.get(group_idx, 'Unknown')
+        src_country = src_countries.get(group_idx, 'Unknown')
+        dest_country = dest_countries.get(group_idx, 'Unknown')
         
         # Check if route_id already exists for this year (aggregate across all groups)
         if route_id not in data_by_year[year_str]:
@@ -581,13 +936,13 @@ def create_hierarchical_data_by_year(df):
                     'name': source_name,
                     'coordinates': [float(src_x), float(src_y)],
                     'country': src_country,
-                    'is_urban': str(route_df['source_wit'].mode()[0]).lower() == 'yes' if 'source_wit' in route_df.columns and len(route_df['source_wit'].mode()) > 0 else False
+                    'is_urban': source_urban.get(group_idx, False)
                 },
                 'destination': {
                     'name': dest_name,
                     'coordinates': [float(dest_x), float(dest_y)],
                     'country': dest_country,
-                    'is_urban': str(route_df['destination_within_urban_boundary'].mode()[0]).lower() == 'yes' if 'destination_within_urban_boundary' in route_df.columns and len(route_df['destination_within_urban_boundary'].mode()) > 0 else False
+                    'is_urban': dest_urban.get(group_idx, False)
                 },
                 'via_city': {
                     'name': city_name if city_name != 'direct' else None,
@@ -603,16 +958,11 @@ def create_hierarchical_data_by_year(df):
         
         # Aggregate flows and quantity
         route_data = data_by_year[year_str][route_id]
-        route_data['flow'] += len(route_df)
-        route_data['quantity'] += float(route_df['total_quantity'].sum()) if not route_df['total_quantity'].isna().all() else 0
+        route_data['flow'] += group_totals[group_idx]['flows']
+        route_data['quantity'] += group_totals[group_idx]['quantity']
         
         # Process commodities
-        for _, row in route_df.iterrows():
-            commodity = row['commodit_1'] if pd.notna(row['commodit_1']) else 'Unknown'
-            category = row['commodit_2'] if pd.notna(row['commodit_2']) else 'Unknown'
-            transport = row['means_of_t'] if pd.notna(row['means_of_t']) else 'Unknown'
-            quantity_val = float(row['total_quantity']) if pd.notna(row['total_quantity']) else 0
-            
+        for commodity, category, transport, quantity, flow in details_by_group[group_idx]:
             # Initialize commodity if not exists
             if commodity not in route_data['commodity']:
                 route_data['commodity'][commodity] = {
@@ -622,18 +972,19 @@ def create_hierarchical_data_by_year(df):
                 }
             
             # Aggregate commodity quantity
-            route_data['commodity'][commodity]['quantity'] += quantity_val
+            commodity_data = route_data['commodity'][commodity]
+            commodity_data['quantity'] += quantity
             
             # Initialize transport if not exists
-            if transport not in route_data['commodity'][commodity]['transport']:
-                route_data['commodity'][commodity]['transport'][transport] = {
+            if transport not in commodity_data['transport']:
+                commodity_data['transport'][transport] = {
                     'quantity': 0.0,
                     'flow': 0
                 }
             
             # Aggregate transport data
-            route_data['commodity'][commodity]['transport'][transport]['quantity'] += quantity_val
-            route_data['commodity'][commodity]['transport'][transport]['flow'] += 1
+            commodity_data['transport'][transport]['quantity'] += quantity
+            commodity_data['transport'][transport]['flow'] += flow
     
     # Convert defaultdict to regular dict
     result = {year: dict(routes) for year, routes in data_by_year.items()}
@@ -658,7 +1009,7 @@ def main():
     
     # Check if food_flows_by_year.json already exists
     hierarchical_file = 'food_flows_by_year_round1.json'  # round(1) = 11km精度
-    temp_file = 'food_flows_by_year_round1_temp.json'
+    temp_file = TEMP_FILE
     
     # Priority 1: Check for existing hierarchical data (skip data processing)
     if os.path.exists(hierarchical_file) and use_osrm:
@@ -675,8 +1026,7 @@ def main():
         
         if response.lower() == 'y':
             print(f"   Loading existing hierarchical data...")
-            with open(hierarchical_file, 'r', encoding='utf-8') as f:
-                hierarchical_data = json.load(f)
+            hierarchical_data = load_json(hierarchical_file)
             
             total_routes = sum(len(routes) for routes in hierarchical_data.values())
             print(f"   ✓ Loaded {total_routes} routes from {len(hierarchical_data)} years")
@@ -684,21 +1034,24 @@ def main():
             # Convert hierarchical data back to flat all_routes (for OSRM processing)
             print(f"   Converting to flat route list...")
             all_routes = []
+            # (起点坐标, 终点坐标, 中转城市) → all_routes 中的路线，查找已有路线只需一次字典查询
+            route_index = {}
             for year_str, year_routes in hierarchical_data.items():
                 for route_id, route_data in year_routes.items():
                     # Check if this route already exists in all_routes
-                    existing = next((r for r in all_routes 
-                                   if r['source']['coordinates'] == route_data['source']['coordinates'] 
-                                   and r['destination']['coordinates'] == route_data['destination']['coordinates']
-                                   and r.get('via_city', {}).get('name') == route_data.get('via_city', {}).get('name')), 
-                                   None)
+                    route_key = (
+                        tuple(route_data['source']['coordinates']),
+                        tuple(route_data['destination']['coordinates']),
+                        route_data.get('via_city', {}).get('name')
+                    )
+                    existing = route_index.get(route_key)
                     
                     if existing:
                         # Merge years
                         if int(year_str) not in existing['years']:
                             existing['years'].append(int(year_str))
                         # Copy path if exists
-                        if 'path' in route_data and route_data['path']:
+                        if has_path(route_data):
                             existing['path'] = route_data['path']
                             existing['distance_km'] = route_data.get('distance_km')
                             existing['duration_hours'] = route_data.get('duration_hours')
@@ -712,13 +1065,15 @@ def main():
                             'quantity': route_data['quantity'],
                             'is_international': route_data['is_international'],
                             'flow_type': route_data['flow_type'],
-                            'years': [int(year_str)]
+                            'years': [int(year_str)],
+                            'route_id': route_id
                         }
-                        if 'path' in route_data and route_data['path']:
+                        if has_path(route_data):
                             new_route['path'] = route_data['path']
                             new_route['distance_km'] = route_data.get('distance_km')
                             new_route['duration_hours'] = route_data.get('duration_hours')
                         all_routes.append(new_route)
+                        route_index[route_key] = new_route
             
             print(f"   ✓ Converted to {len(all_routes)} unique routes")
             
@@ -732,8 +1087,9 @@ def main():
             print(f"   Starting fresh analysis...")
             df = load_and_clean_data(csv_path)
             overall_analysis, df_with_types = analyze_rural_urban_patterns(df)
-            all_routes = create_routes_with_rural_urban(df_with_types, min_flows=1)
-            hierarchical_data = create_hierarchical_data_by_year(df_with_types)
+            city_coords_lookup = build_city_coordinates_lookup(df_with_types)
+            all_routes = create_routes_with_rural_urban(df_with_types, city_coords_lookup, min_flows=1)
+            hierarchical_data = create_hierarchical_data_by_year(df_with_types, city_coords_lookup)
     
     # Priority 2: Check for temporary file (resume from interruption)
     elif use_osrm and os.path.exists(temp_file):
@@ -750,8 +1106,7 @@ def main():
         
         if response.lower() == 'y':
             print(f"   Loading partial hierarchical data...")
-            with open(temp_file, 'r', encoding='utf-8') as f:
-                hierarchical_data = json.load(f)
+            hierarchical_data = load_json(temp_file)
             
             # Load original data and rebuild all_routes for OSRM processing
             df = load_and_clean_data(csv_path)
@@ -777,8 +1132,9 @@ def main():
             for flow_type, data in overall_analysis['flow_patterns'].items():
                 print(f"   {data['label']:20s}: {data['count']:6,} ({data['percentage']:5.2f}%)")
             print("\n2. Creating Route Files")
-            all_routes = create_routes_with_rural_urban(df_with_types, min_flows=1)
-            hierarchical_data = create_hierarchical_data_by_year(df_with_types)
+            city_coords_lookup = build_city_coordinates_lookup(df_with_types)
+            all_routes = create_routes_with_rural_urban(df_with_types, city_coords_lookup, min_flows=1)
+            hierarchical_data = create_hierarchical_data_by_year(df_with_types, city_coords_lookup)
     else:
         # Normal flow - fresh start
         df = load_and_clean_data(csv_path)
@@ -799,12 +1155,15 @@ def main():
         # Create route files
         print("\n2. Creating Route Files")
         
+        # 中转城市坐标表只构建一次，两个构建函数共用
+        city_coords_lookup = build_city_coordinates_lookup(df_with_types)
+        
         # All routes (only file needed for visualization)
-        all_routes = create_routes_with_rural_urban(df_with_types, min_flows=1)
+        all_routes = create_routes_with_rural_urban(df_with_types, city_coords_lookup, min_flows=1)
         
         # NEW: Create hierarchical data structure by year
         print("\n3. Creating Hierarchical Data Structure by Year")
-        hierarchical_data = create_hierarchical_data_by_year(df_with_types)
+        hierarchical_data = create_hierarchical_data_by_year(df_with_types, city_coords_lookup)
     
     # OSRM路径获取 (可选)
     import sys
@@ -815,89 +1174,86 @@ def main():
         print("\n3. Fetching OSRM Real Route Paths...")
         load_route_cache()
         
-        # 加载之前的进度
+        # 上次中断时的进度（中断前已获取的路线都在缓存中，重新运行时直接命中缓存，无需从中断处接着数）
         previous_progress = load_progress()
-        start_from = 0
         if previous_progress:
-            response = input(f"   Continue from previous progress ({previous_progress['processed']}/{previous_progress['total']})? (y/n): ")
-            if response.lower() == 'y':
-                start_from = previous_progress['processed']
+            print(f"   Routes fetched before the interruption will be loaded from the cache")
         
         # 选择要处理的routes
         if top_100_only:
-            routes_to_process = sorted(all_routes, key=lambda x: x['flows'], reverse=True)[:100]
+            selected_routes = sorted(all_routes, key=lambda x: x['flows'], reverse=True)[:100]
             print(f"   Processing TOP 100 routes only")
         else:
-            routes_to_process = all_routes
+            selected_routes = all_routes
             print(f"   Processing ALL {len(all_routes)} routes")
         
-        success_count = 0
+        # 循环前一次过滤：只请求还没有路径、且有中转城市坐标的路线
+        routes_to_process = [
+            route for route in selected_routes
+            if not has_path(route) and route.get('via_city') and route['via_city'].get('coordinates')
+        ]
+        
+        success_count = sum(1 for route in selected_routes if has_path(route))  # 已有路径的路线计为成功
         fail_count = 0
-        batch_size = 50  # 每50个保存一次缓存和中间结果
-        idx = start_from  # Initialize idx for error handling
+        batch_size = 50  # 每50个保存一次缓存和进度
+        idx = 0  # Initialize idx for error handling
         start_time = time.time()
         
-        print(f"\n   Starting from route {start_from + 1}/{len(routes_to_process)}")
+        print(f"\n   {len(routes_to_process)} routes need OSRM paths ({success_count} already have one)")
         print(f"   Cache will be saved every {batch_size} routes")
         print(f"   Press Ctrl+C to safely stop (progress will be saved)\n")
         
+        def fetch(route):
+            """
+            工作线程：请求一条路线的OSRM路径（限流在 get_osrm_route 中），并在本线程中简化
+            返回要写回路线的字段（失败时为 None），原始路径不再交给主线程，用完即释放
+            """
+            route_id = f"{route['source']['name']}-{route['via_city']['name']}-{route['destination']['name']}"
+            osrm_result = get_osrm_route(
+                route['source']['coordinates'],
+                route['via_city']['coordinates'],
+                route['destination']['coordinates'],
+                route_id
+            )
+            if not osrm_result:
+                return route_id, None
+            # 简化路径：从平均 2919 点减少到 ~50 点
+            simplified_path = simplify_path(osrm_result['path'], epsilon=0.001)
+            return route_id, {
+                'path': round_path(simplified_path),
+                'distance_km': round(osrm_result['distance_km'], 2),
+                'duration_hours': round(osrm_result['duration_hours'], 3),
+                'path_points_original': len(osrm_result['path']),  # 记录原始点数
+                'path_points_simplified': len(simplified_path)
+            }
+        
+        # 路径在循环结束后才合并进 hierarchical_data，循环中它不会变化：中间结果开始前保存一次即可
+        # （检查点只写新路线和进度，都很小；线程池在后台持续发请求，不会因检查点停顿）
+        save_intermediate_results(hierarchical_data)
+        
+        # 两个阶段：工作线程请求并简化路径；主线程按路线顺序取回结果，写回字段、更新进度和保存
+        # 已提交的任务数有上限，主线程处理不过来时工作线程自然等待
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
         try:
-            for idx, route in enumerate(routes_to_process, 1):
-                # 跳过已处理的
-                if idx <= start_from:
-                    # 检查是否已有path数据
-                    if 'path' in route:
-                        success_count += 1
-                    continue
-                
-                # ✅ 关键修复：跳过已有路径的路线
-                if 'path' in route and route['path']:
-                    success_count += 1
-                    print_progress_bar(idx, len(routes_to_process), success_count, fail_count, start_time, 'OSRM')
-                    continue
-                
-                # 只处理有via_city的路线
-                if 'via_city' not in route or not route['via_city'] or not route['via_city'].get('coordinates'):
-                    # 显示进度条（跳过此路线）
-                    print_progress_bar(idx, len(routes_to_process), success_count, fail_count, start_time, 'OSRM')
-                    continue
-                
-                source_coords = route['source']['coordinates']
-                via_coords = route['via_city']['coordinates']
-                dest_coords = route['destination']['coordinates']
-                route_id = f"{route['source']['name']}-{route['via_city']['name']}-{route['destination']['name']}"
-                
-                # 获取OSRM路径
-                osrm_result = get_osrm_route(source_coords, via_coords, dest_coords, route_id)
-                
-                if osrm_result:
-                    # 简化路径：从平均 2919 点减少到 ~50 点
-                    original_points = len(osrm_result['path'])
-                    simplified_path = simplify_path(osrm_result['path'], epsilon=0.001)
-                    
-                    route['path'] = simplified_path
-                    route['distance_km'] = osrm_result['distance_km']
-                    route['duration_hours'] = osrm_result['duration_hours']
-                    route['path_points_original'] = original_points  # 记录原始点数
-                    route['path_points_simplified'] = len(simplified_path)
+            results = bounded_map(executor, fetch, routes_to_process)
+            for idx, (route, (route_id, route_fields)) in enumerate(zip(routes_to_process, results), 1):
+                if route_fields:
+                    route.update(route_fields)
                     success_count += 1
                 else:
                     # 失败时保留直线（不添加path字段，前端会fallback到ArcLayer）
                     fail_count += 1
                 
-                # 更新进度条
-                print_progress_bar(idx, len(routes_to_process), success_count, fail_count, start_time, 'OSRM')
+                # 更新进度条（保存检查点前强制重绘，换行后显示的是准确的进度）
+                print_progress_bar(idx, len(routes_to_process), success_count, fail_count, start_time, 'OSRM',
+                                   force=idx % batch_size == 0)
                 
-                # 分批保存缓存、进度和中间结果
+                # 分批保存缓存和进度
                 if idx % batch_size == 0:
                     print()  # 新行
                     save_route_cache()
                     save_progress(idx, len(routes_to_process), route_id)
-                    save_intermediate_results(hierarchical_data)
                     print(f"   💾 Checkpoint saved at {idx}/{len(routes_to_process)}")
-                
-                # 限流：每次请求间隔0.1秒
-                time.sleep(0.1)
         
         except KeyboardInterrupt:
             print(f"\n\n⚠️  Interrupted by user!")
@@ -911,9 +1267,8 @@ def main():
             print(f"\n   Saving progress before exit...")
             save_route_cache()
             save_progress(idx, len(routes_to_process), route_id if 'route_id' in locals() else 'interrupted')
-            save_intermediate_results(hierarchical_data)
-            print(f"   ✓ Progress saved. Run script again to continue from route {idx}")
-            print(f"   ✓ Partial results saved to food_flows_by_year_temp.json")
+            print(f"   ✓ Progress saved. Run script again to continue (routes fetched so far are cached)")
+            print(f"   ✓ Partial results saved to {TEMP_FILE}")
             sys.exit(0)
         
         except Exception as e:
@@ -921,13 +1276,17 @@ def main():
             print(f"   Saving progress before exit...")
             save_route_cache()
             save_progress(idx, len(routes_to_process), route_id if 'route_id' in locals() else 'error')
-            save_intermediate_results(hierarchical_data)
             print(f"   ✓ Progress saved to resume later")
             raise
         
+        finally:
+            # 中断时取消尚未开始的请求，不等待剩余路线全部请求完
+            executor.shutdown(wait=False, cancel_futures=True)
+        
         # 完成后显示最终进度条
-        print_progress_bar(len(routes_to_process), len(routes_to_process), success_count, fail_count, start_time, 'OSRM')
-        print()  # 新行
+        if routes_to_process:
+            print_progress_bar(len(routes_to_process), len(routes_to_process), success_count, fail_count, start_time, 'OSRM')
+            print()  # 新行
         
         # 最后保存一次
         save_route_cache()
@@ -958,36 +1317,33 @@ def main():
         total_points_before = 0
         total_points_after = 0
         
+        # route_id → {年份: 该年的路线数据}，只扫描一遍 hierarchical_data
+        # （同一 route_id 可能出现在该路线 years 之外的年份（flow_type 不同），仍只写入路线自己的年份）
+        routes_by_id = defaultdict(dict)
+        for year_str, year_routes in hierarchical_data.items():
+            for route_id, route_data in year_routes.items():
+                routes_by_id[route_id][year_str] = route_data
+        
         for route in all_routes:
-            if 'path' in route and route['path']:
-                # Find this route in hierarchical_data and add path
-                # 使用 round(1) 与聚合精度保持一致
-                src_x = round(route['source']['coordinates'][0], 1)
-                src_y = round(route['source']['coordinates'][1], 1)
-                dest_x = round(route['destination']['coordinates'][0], 1)
-                dest_y = round(route['destination']['coordinates'][1], 1)
-                
-                # Determine city_name
-                if route.get('via_city') and route['via_city'].get('name'):
-                    city_name = route['via_city']['name']
-                else:
-                    city_name = 'direct'
-                
-                route_id = f"r_{src_x}_{src_y}_{dest_x}_{dest_y}_{city_name}"
+            if has_path(route):
+                # Find this route in hierarchical_data and add path (route_id 在创建路线时已算好)
+                route_id = route['route_id']
                 
                 # Add path to all years this route appears in
-                for year in route.get('years', []):
-                    year_str = str(year)
-                    if year_str in hierarchical_data and route_id in hierarchical_data[year_str]:
-                        hierarchical_data[year_str][route_id]['path'] = route['path']
-                        hierarchical_data[year_str][route_id]['distance_km'] = route.get('distance_km')
-                        hierarchical_data[year_str][route_id]['duration_hours'] = route.get('duration_hours')
-                        paths_added += 1
-                        
-                        # 统计简化效果
-                        if 'path_points_original' in route:
-                            total_points_before += route['path_points_original']
-                            total_points_after += route['path_points_simplified']
+                routes_by_year = routes_by_id.get(route_id)
+                if not routes_by_year:
+                    continue
+                targets = [routes_by_year[year_str] for year_str in map(str, route.get('years', [])) if year_str in routes_by_year]
+                for target in targets:
+                    target['path'] = route['path']
+                    target['distance_km'] = route.get('distance_km')
+                    target['duration_hours'] = route.get('duration_hours')
+                paths_added += len(targets)
+                
+                # 统计简化效果
+                if 'path_points_original' in route:
+                    total_points_before += route['path_points_original'] * len(targets)
+                    total_points_after += route['path_points_simplified'] * len(targets)
         
         print(f"   ✓ Added {paths_added} OSRM paths to hierarchical data")
         if total_points_before > 0:
@@ -1001,8 +1357,8 @@ def main():
         # Only save hierarchical format by year (the one we actually use)
         # hierarchical_file already defined at the top of main()
         print(f"   Saving {hierarchical_file}...")
-        with open(hierarchical_file, 'w', encoding='utf-8') as f:
-            json.dump(hierarchical_data, f, indent=2, ensure_ascii=False)
+        # 紧凑JSON：index.html 用 response.json() 整体解析，缩进只会让下载和解析变慢（文件小一半以上）
+        save_json(hierarchical_data, hierarchical_file, indent=False)
         
         total_routes_hierarchical = sum(len(routes) for routes in hierarchical_data.values())
         print(f"   ✓ Saved {hierarchical_file} ({total_routes_hierarchical} routes across {len(hierarchical_data)} years)")
@@ -1036,7 +1392,7 @@ def main():
         # Count routes with paths
         routes_with_paths = sum(1 for year_routes in hierarchical_data.values() 
                                for route in year_routes.values() 
-                               if 'path' in route and route['path'])
+                               if has_path(route))
         total_routes = sum(len(routes) for routes in hierarchical_data.values())
         print(f"  - Total routes: {total_routes:,}")
         print(f"  - Routes with OSRM paths: {routes_with_paths:,} ({routes_with_paths/total_routes*100:.1f}%)")